@@ -6,12 +6,15 @@
 #
 
 import os
+import hashlib
+import pickle
 
 from .lazyalg import *
 from .lexer import *
 from .parser import *
 from .types import *
 from .error import *
+from .sim import evalClassical, evalCplxArray, isUnitary, requireNumpy, np
         
 def assertArgType(funcname, args, argidx, validtypes, pos = None, word = False, singlearg = False):
     if type(validtypes) != list:
@@ -41,15 +44,99 @@ def assertArgType(funcname, args, argidx, validtypes, pos = None, word = False,
         return argtype
         
 class Storage:
+    __slots__ = ('fridx', 'value', 'isFixed')
+    
     def __init__(self, fridx, value = None, isFixed = False):
         self.fridx = fridx
         self.value = value
         self.isFixed = isFixed
+
+#Names which were ever bound outside the global frame, other names are looked up in the global frame directly
+localnames = set()
+
+#Default size of the per logic cache of script function results
+maxmemo = 4096
+
+#Directory of the on-disk cache of parsed source files, None disables it
+cachedir = os.environ.get('QUBLA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'qubla'))
+
+#Number of parsed sources kept in memory, shared by all logics
+maxparsed = 64
+
+parsecache = {}
+parserversion = None
+
+class Scope:
+    # Lexical scope of a function body or a block: the names bound in it get fixed slot indices
+    def __init__(self, arrcmd, args = [], parent = None):
+        self.parent = parent
+        self.slots = {}
+        for name in args:
+            self.addName(name)
+        for cmd in arrcmd:
+            self.collectNames(cmd)
+            
+    def addName(self, name):
+        if name not in self.slots:
+            self.slots[name] = len(self.slots)
+            localnames.add(name)
+            
+    def collectNames(self, cmd):
+        if cmd == None:
+            return
+        if cmd.typeid == 'CMDCALC':
+            for tgtexp in cmd.tgtarr:
+                if tgtexp != None and tgtexp.typeid == 'EXPNAME':
+                    self.addName(tgtexp.name)
+        elif cmd.typeid == 'CMDFOR':
+            self.addName(cmd.varname)
+            self.collectNames(cmd.command)
+        elif cmd.typeid == 'CMDIF':
+            self.collectNames(cmd.iftrue)
+            self.collectNames(cmd.iffalse)
+        elif cmd.typeid == 'CMDWHILE':
+            self.collectNames(cmd.command)
+            
+    def resolve(self, name):
+        #Returns the (frame index counted from the top, slot index) pairs of the enclosing scopes binding name, and the number of enclosing scopes
+        chain = []
+        scope = self
+        depth = 0
+        while scope != None:
+            depth += 1
+            idx = scope.slots.get(name)
+            if idx != None:
+                chain.append((-depth, idx))
+            scope = scope.parent
+        return chain, depth
+
+class Frame:
+    __slots__ = ('layout', 'slots', 'names')
+    
+    def __init__(self, scope = None):
+        self.layout = scope.slots if scope != None else {}
+        self.slots = [None] * len(self.layout)
+        self.names = {} #names bound outside the layout of the scope
+        
+    def get(self, name):
+        idx = self.layout.get(name)
+        if idx != None:
+            return self.slots[idx]
+        return self.names.get(name)
+    
+    def bind(self, name, storage):
+        idx = self.layout.get(name)
+        if idx != None:
+            self.slots[idx] = storage
+        else:
+            self.names[name] = storage
         
 def bool2bit(b):
     return QBLBitObject(1 if b else 0) 
 
 class QBLFuncError(QBLInternalFunc):
+    pure = False
+    
     def __init__(self):
         super().__init__('error', 1)
         
@@ -59,6 +146,8 @@ class QBLFuncError(QBLInternalFunc):
         raise QBLRuntimeError(None, arg.value)
         
 class QBLFuncInput(QBLInternalFunc):
+    pure = False
+    
     def __init__(self, qm):
         super().__init__('input', 1)
         self.qm = qm
@@ -84,7 +173,7 @@ class QBLFuncInput(QBLInternalFunc):
                 else:
                     nbits = len(arg.bitstruct)
             if nbits != None:
-                ret = QBLWordObject(arg.signed, [QBLQBitObject(self.qm.allocInputQBit()) for i in range(nbits)])
+                ret = QBLWordObject(arg.signed, QBLWordBits.fromQubits([self.qm.allocInputQBit() for i in range(nbits)]))
                 self.qm.arrinp.append(ret)
                 return ret
                 
@@ -93,6 +182,8 @@ class QBLFuncInput(QBLInternalFunc):
         ))
         
 class QBLFuncOutput(QBLInternalFunc):
+    pure = False
+    
     def __init__(self, qm):
         super().__init__('output', 1)
         self.qm = qm
@@ -144,6 +235,8 @@ def convqstate(qm, starg, sttype, nbits = None):
     return (stbits, state)
              
 class QBLFuncQBInit(QBLInternalFunc):
+    pure = False
+    
     def __init__(self, qm):
         super().__init__('qbinit', 2)
         self.qm = qm
@@ -178,6 +271,8 @@ class QBLFuncQBInit(QBLInternalFunc):
         return None       
         
 class QBLFuncQState(QBLInternalFunc):
+    pure = False
+    
     def __init__(self, qm):
         super().__init__('qstate', 1)
         self.qm = qm
@@ -196,6 +291,8 @@ class QBLFuncQState(QBLInternalFunc):
         return QBLListObject(ret)
 
 class QBLFuncApplyOp(QBLInternalFunc):
+    pure = False
+    
     def __init__(self, qm):
         super().__init__('applyop', 2)
         self.qm = qm
@@ -246,21 +343,13 @@ class QBLFuncApplyOp(QBLInternalFunc):
                 break
                 
         if isutr:
-            evalop = [[z.evaluate() for z in row] for row in opmatr]
-            for i in rbase:
-                for k in rbase:
-                    testval = sum([evalop[i][s] * (evalop[k][s].conjugate()) for s in rbase  ])
-                    if i == k:
-                        testval -= 1.0 + 0j
-                    if (testval * (testval.conjugate())).real > 0.0001:
-                        isutr = False
-                        break
-                if not isutr: break
+            step = StepApplyOp(qbarr, opmatr)
+            isutr = isUnitary(step.getEvalMatr())
                     
         if not isutr:
             raise QBLRuntimeError(None, 'operator failed unitarity test')
                         
-        self.qm.addStep(StepApplyOp(qbarr, opmatr))
+        self.qm.addStep(step)
         return None     
 
 class QBLFuncStartHedge(QBLInternalFunc):
@@ -422,21 +511,7 @@ class QBLFuncRightShift(QBLFuncShift):
         elif argtype.value == 'QBIT':
             return QBLBitObject(0)
         else:             
-            n = len(argval)
-            if sbits < n:
-                r = range(sbits)
-            else:
-                r = range(n)     
-            if argtype.signed:
-                lastbit = argval[n-1]
-            else:
-                lastbit = QBLBitObject(0)
-            retlst = [lastbit for i in r]
-            if sbits < n:
-                retlst2 = argval[sbits:n]
-                retlst2.extend(retlst)
-                retlst = retlst2
-            return QBLWordObject(argtype.signed, retlst)
+            return QBLWordObject(argtype.signed, argval.rshift(sbits, argtype.signed))
         
 class QBLFuncLeftShift(QBLFuncShift):
     def __init__(self):
@@ -453,16 +528,7 @@ class QBLFuncLeftShift(QBLFuncShift):
         elif argtype.value == 'QBIT':
             return QBLBitObject(0) if sbits == 0 else arg
         else:
-            n = len(argval)
-            if sbits < n:
-                r = range(sbits)
-            else:
-                r = range(n)     
-            newbit = QBLBitObject(0)
-            retlst = [newbit for i in r]
-            if sbits < n:
-                retlst.extend(arg.value[0:(n - sbits)])
-            return QBLWordObject(argtype.signed, retlst)
+            return QBLWordObject(argtype.signed, argval.lshift(sbits))
         
 def cplxargs(arg0, type0, arg1, type1, allowint):
     if type0 == QBLObjectType.Cplx:
@@ -593,6 +659,8 @@ class QBLComplexFunc(QBLInternalFunc):
         return QBLCplxObject(ComplexValue(funcname = self.name, arrarg = newargs))
     
 class QBLFuncPrint(QBLInternalFunc):
+    pure = False
+    
     def __init__(self):
         super().__init__('print', 1)
         
@@ -600,7 +668,475 @@ class QBLFuncPrint(QBLInternalFunc):
         print(str(args[0]))
         return None
     
+def isBitType(objtype):
+    return objtype is QBLObjectType.Bit or objtype is QBLObjectType.QBit
+
+def isClassicalWord(obj):
+    return obj.value.qmask == 0
+
+def wordBits(obj):
+    # Unsigned value of the bits of a classical word
+    return obj.value.cval
+
+def bitsWord(signed, n, value):
+    return QBLWordObject(signed, QBLWordBits(n, value & ((1 << n) - 1)))
+
+class QBLNativeFunc(QBLInternalFunc):
+    # Native implementation of a function of the base library for the common argument types. When call returns
+    # NotImplemented (before having any effect), the library version of the function (fallback) is called instead.
+    def __init__(self, qm, name, nargs, tblnames):
+        super().__init__(name, nargs)
+        self.qm = qm
+        self.fallback = None
+        self.tblnames = tblnames
+        
+    def getFunc(self, name, nargs):
+        storage = self.qm.globalfr.get(name)
+        if storage == None or storage.value == None or storage.value.objtype is not QBLObjectType.FuncList:
+            return None
+        return storage.value.value.get(nargs)
+        
+    def getTables(self):
+        # The table functions used by the library version by name, None if any of them was redefined otherwise
+        ret = {}
+        for name in self.tblnames:
+            storage = self.qm.globalfr.get(name)
+            if storage == None or storage.value == None or storage.value.objtype is not QBLObjectType.FuncList:
+                return None
+            for tblfunc in storage.value.value.values():
+                if tblfunc.functype != 'TABLE':
+                    return None
+                ret[name] = tblfunc
+        return ret
+    
+    def extend(self, wordtype, n, obj):
+        return self.qm.cast(QBLStructuredWordType(wordtype, n), obj)
+    
+    def call(self, args):
+        tbls = self.getTables()
+        if tbls == None:
+            return NotImplemented
+        return self.callNative(args, tbls)
+    
+class QBLNativeAddSub(QBLNativeFunc):
+    def __init__(self, qm, isadd):
+        super().__init__(qm, '+' if isadd else '-', 2, ['add3bit' if isadd else 'sub3bit'])
+        self.isadd = isadd
+        self.clop = QBLFuncAdd() if isadd else QBLFuncSub()
+        
+    def callNative(self, args, tbls):
+        x, y = args
+        optbl = tbls[self.tblnames[0]]
+        typex = x.getType()
+        typey = y.getType()
+        if typex is QBLObjectType.Cplx or typey is QBLObjectType.Cplx:
+            return NotImplemented
+        iwx = typex.value == 'WORD'
+        iwy = typey.value == 'WORD'
+        if iwx or iwy:
+            if iwx and iwy:
+                nx = len(x.value)
+                ny = len(y.value)
+                if nx < ny:
+                    x = self.extend(typex, ny, x)
+                    n = ny
+                elif ny < nx:
+                    y = self.extend(typey, nx, y)
+                    n = nx
+                else:
+                    n = nx
+                signed = typex.signed or typey.signed
+                swap = False
+            else:
+                swap = iwy
+                if swap:
+                    x, y = y, x
+                    typex, typey = typey, typex
+                n = len(x.value)
+                if typey is QBLObjectType.Int:
+                    y = self.extend(typex, n, QBLIntObject(y.value - ((y.value >> n) << n)))
+                elif isBitType(typey):
+                    y = self.extend(QBLWordType.UWord, n, y)
+                else:
+                    return NotImplemented
+                signed = typex.signed
+            if swap:
+                x, y = y, x
+                
+            if isClassicalWord(x) and isClassicalWord(y):
+                if self.isadd:
+                    return bitsWord(signed, n, wordBits(x) + wordBits(y))
+                else:
+                    return bitsWord(signed, n, wordBits(x) - wordBits(y))
+            
+            qm = self.qm
+            ret = []
+            carry = QBLBitObject(0)
+            qm.startHedge()
+            for i in range(n):
+                addres = qm.callTable(None, optbl, [x.value[i], y.value[i], carry]).value
+                ret.append(addres[0])
+                carry = addres[1]
+            qm.endHedge()
+            return QBLWordObject(signed, ret)
+        
+        iix = typex is QBLObjectType.Int
+        iiy = typey is QBLObjectType.Int
+        if iix or iiy:
+            if iix and iiy:
+                return self.clop.call([x, y])
+            if iix and typey is QBLObjectType.Bit:
+                return self.clop.call([x, QBLIntObject(y.value)])
+            if iiy and typex is QBLObjectType.Bit:
+                return self.clop.call([QBLIntObject(x.value), y])
+            return NotImplemented
+        if isBitType(typex) and isBitType(typey):
+            return self.qm.callTable(None, optbl, [x, y, QBLIntObject(0)]).value[0]
+        return NotImplemented
+    
+class QBLNativeIfElse(QBLNativeFunc):
+    def __init__(self, qm):
+        super().__init__(qm, 'ifelse', 3, ['ifelse3bit'])
+        
+    def callNative(self, args, tbls):
+        cond, obj1, obj2 = args
+        typec = cond.getType()
+        if typec is QBLObjectType.Bit:
+            return obj1 if cond.value != 0 else obj2
+        if typec is not QBLObjectType.QBit:
+            return NotImplemented
+        iftbl = tbls['ifelse3bit']
+        typ1 = obj1.getType()
+        typ2 = obj2.getType()
+        iw1 = typ1.value == 'WORD'
+        iw2 = typ2.value == 'WORD'
+        qm = self.qm
+        if iw1 or iw2:
+            swap = False
+            if iw1 and iw2:
+                if typ1.signed != typ2.signed:
+                    return NotImplemented
+                n1 = len(obj1.value)
+                n2 = len(obj2.value)
+                if n1 < n2:
+                    n = n2
+                    obj1 = self.extend(typ1, n, obj1)
+                else:
+                    n = n1
+                    obj2 = self.extend(typ2, n, obj2)
+            else:
+                if iw2:
+                    obj1, obj2 = obj2, obj1
+                    typ1, typ2 = typ2, typ1
+                    swap = True
+                n = len(obj1.value)
+                obj2 = self.extend(typ1, n, obj2)
+                if obj2 == None:
+                    return NotImplemented
+            if swap:
+                obj1, obj2 = obj2, obj1
+            ret = []
+            qm.startHedge()
+            for i in range(n):
+                ret.append(qm.callTable(None, iftbl, [cond, obj1.value[i], obj2.value[i]]).value[0])
+            qm.endHedge()
+            return QBLWordObject(typ1.signed, ret)
+        if isBitType(typ1) and isBitType(typ2):
+            return qm.callTable(None, iftbl, [cond, obj1, obj2]).value[0]
+        return NotImplemented
+    
+class QBLNativeMul(QBLNativeFunc):
+    def __init__(self, qm):
+        super().__init__(qm, '*', 2, ['and2bit'])
+        self.clop = QBLFuncMul()
+        
+    def callNative(self, args, tbls):
+        x, y = args
+        typex = x.getType()
+        typey = y.getType()
+        if typex is QBLObjectType.Cplx or typey is QBLObjectType.Cplx:
+            return NotImplemented
+        iwx = typex.value == 'WORD'
+        iwy = typey.value == 'WORD'
+        qm = self.qm
+        if iwx or iwy:
+            if iwx and iwy:
+                n = len(x.value) + len(y.value)
+                rettyp = QBLWordType.Word if typex.signed or typey.signed else QBLWordType.UWord
+            else:
+                if iwy:
+                    x, y = y, x
+                    typex, typey = typey, typex
+                rettyp = typex
+                n = len(x.value)
+            x = self.extend(rettyp, n, x)
+            y = self.extend(rettyp, n, y)
+            if x == None or y == None:
+                return NotImplemented
+            if isClassicalWord(x) and isClassicalWord(y):
+                return bitsWord(rettyp.signed, n, wordBits(x) * wordBits(y))
+            
+            #The products are summed by the functions the library version calls
+            natadd = self.getFunc('+', 2)
+            natifelse = self.getFunc('ifelse', 3)
+            shl = self.getFunc('<<', 2)
+            if type(natadd) != QBLNativeAddSub or type(natifelse) != QBLNativeIfElse or type(shl) != QBLFuncLeftShift:
+                return NotImplemented
+            addtbls = natadd.getTables()
+            iftbls = natifelse.getTables()
+            if addtbls == None or iftbls == None:
+                return NotImplemented
+            wzero = self.extend(rettyp, n, QBLIntObject(0))
+            ret = wzero
+            qm.startHedge()
+            for i in range(n):
+                qm.startHedge()
+                prod = natifelse.callNative([x.value[i], shl.call([y, QBLIntObject(i)]), wzero], iftbls)
+                ret = natadd.callNative([ret, prod], addtbls)
+                qm.endHedge()
+            qm.endHedge()
+            return ret
+        
+        iix = typex is QBLObjectType.Int
+        iiy = typey is QBLObjectType.Int
+        if iix or iiy:
+            if iix and iiy:
+                return self.clop.call([x, y])
+            if iix and typey is QBLObjectType.Bit:
+                return self.clop.call([x, QBLIntObject(y.value)])
+            if iiy and typex is QBLObjectType.Bit:
+                return self.clop.call([y, QBLIntObject(x.value)])
+            return NotImplemented
+        if isBitType(typex) and isBitType(typey):
+            return qm.callTable(None, tbls['and2bit'], [x, y]).value[0]
+        return NotImplemented
+    
+class QBLNativeEqual(QBLNativeFunc):
+    def __init__(self, qm, iseq):
+        super().__init__(qm, '==' if iseq else '!=', 2, ['equal3bit' if iseq else 'nequal3bit', 'not1bit'])
+        self.iseq = iseq
+        
+    def ident(self, x, y):
+        if self.iseq:
+            return bool2bit(x == y)
+        else:
+            return bool2bit(x.value != y.value)
+        
+    def callNative(self, args, tbls):
+        x, y = args
+        qm = self.qm
+        iseq = self.iseq
+        eqtbl = tbls[self.tblnames[0]]
+        isneq = bool2bit(not iseq)
+        typex = x.getType()
+        typey = y.getType()
+        if typex is QBLObjectType.Int or typey is QBLObjectType.Int:
+            if typex == typey:
+                return self.ident(x, y)
+            elif typey is QBLObjectType.Int:
+                x, y = y, x
+                typex, typey = typey, typex
+            if typey is QBLObjectType.Bit:
+                return self.ident(x, QBLIntObject(y.value))
+            elif typey is QBLObjectType.QBit:
+                if x.value == (1 if iseq else 0):
+                    return y
+                elif x.value == (0 if iseq else 1):
+                    return qm.callTable(None, tbls['not1bit'], [y])
+            elif typey.value == 'WORD':
+                if isClassicalWord(y):
+                    return bool2bit((x.value == y.toint()) == iseq)
+                n = len(y.value)
+                if typey.signed:
+                    remi = x.value >> (n - 1)
+                    if remi != 0 and remi != -1:
+                        return isneq
+                else:
+                    if x.value >> n != 0:
+                        return isneq
+                ret = bool2bit(iseq)
+                qm.startHedge()
+                for i in range(n - 1, -1, -1):
+                    ret = qm.callTable(None, eqtbl, [x[i], y.value[i], ret]).value[0]
+                qm.endHedge()
+                return ret
+            return isneq
+        
+        iwx = typex.value == 'WORD'
+        iwy = typey.value == 'WORD'
+        if iwx or iwy:
+            if iwx and iwy:
+                nx = len(x.value)
+                ny = len(y.value)
+                if nx < ny:
+                    x = self.extend(typex, ny, x)
+                    n = ny
+                elif ny < nx:
+                    y = self.extend(typey, nx, y)
+                    n = nx
+                else:
+                    n = nx
+            else:
+                if iwy:
+                    x, y = y, x
+                    typex, typey = typey, typex
+                n = len(x.value)
+                if isBitType(typey):
+                    y = self.extend(QBLWordType.UWord, n, y)
+                else:
+                    return isneq
+            #words of different signedness are compared by the tables, the sign bits are handled there
+            if x.objtype.signed == y.objtype.signed and isClassicalWord(x) and isClassicalWord(y):
+                return bool2bit((x.toint() == y.toint()) == iseq)
+            nm = n - 1
+            qm.startHedge()
+            if x.objtype.signed != y.objtype.signed:
+                ret = qm.callTable(None, eqtbl, [x.value[nm], QBLIntObject(0), 
+                    qm.callTable(None, eqtbl, [y.value[nm], QBLIntObject(0), QBLIntObject(1)]).value[0]]).value[0]
+                nm -= 1
+            else:
+                ret = bool2bit(iseq)
+            for i in range(nm, -1, -1):
+                if ret == isneq:
+                    qm.endHedge()
+                    return isneq
+                ret = qm.callTable(None, eqtbl, [x.value[i], y.value[i], ret]).value[0]
+            qm.endHedge()
+            return ret
+        if isBitType(typex) and isBitType(typey):
+            return qm.callTable(None, eqtbl, [x, y, bool2bit(iseq)]).value[0]
+        return self.ident(x, y)
+
+class QBLNativeLessThan(QBLNativeFunc):
+    def __init__(self, qm, name, revargs, incleq):
+        super().__init__(qm, name, 2, ['cmp4bit', 'leq4bit', 'or2bit', 'nor2bit', 'not1bit'])
+        self.revargs = revargs
+        self.incleq = incleq
+        
+    def callNative(self, args, tbls):
+        if self.revargs:
+            y, x = args
+        else:
+            x, y = args
+        qm = self.qm
+        incleq = self.incleq
+        bit0 = QBLBitObject(0)
+        bit1 = QBLBitObject(1)
+        cmptbl = tbls['cmp4bit']
+        lastcmp = tbls['leq4bit'] if incleq else cmptbl
+        typex = x.getType()
+        typey = y.getType()
+        isintx = typex is QBLObjectType.Int
+        isinty = typey is QBLObjectType.Int
+        if typex is QBLObjectType.Bit:
+            x = QBLIntObject(x.value)
+            isintx = True
+        elif typex is QBLObjectType.QBit:
+            x = self.extend(QBLWordType.UWord, 1, x)
+        if typey is QBLObjectType.Bit:
+            y = QBLIntObject(y.value)
+            isinty = True
+        elif typey is QBLObjectType.QBit:
+            y = self.extend(QBLWordType.UWord, 1, y)
+            
+        iwx = x.getType().value == 'WORD'
+        iwy = y.getType().value == 'WORD'
+        #classical unsigned words are compared directly, signed ones are ordered as the tables order them
+        if (isintx or iwx and not x.objtype.signed and isClassicalWord(x)) and (isinty or iwy and not y.objtype.signed and isClassicalWord(y)) and not (isintx and isinty):
+            xval = x.value if isintx else x.toint()
+            yval = y.value if isinty else y.toint()
+            return bool2bit(xval <= yval if incleq else xval < yval)
+        if isintx or isinty:
+            if isintx and isinty:
+                if incleq:
+                    return qm.callTable(None, tbls['not1bit'], [bool2bit(y.value < x.value)]).value[0]
+                else:
+                    return bool2bit(x.value < y.value)
+            oldx = x
+            oldy = y
+            if isinty:
+                x, y = oldy, oldx
+                iwy = iwx
+                clt = bit0
+                cgt = bit1
+            else:
+                clt = bit1
+                cgt = bit0
+            if not iwy:
+                return NotImplemented
+            n = len(y.value)
+            nm = n - 1
+            if y.objtype.signed:
+                remi = x.value >> nm
+                if remi < -1:
+                    return clt
+                elif 0 < remi:
+                    return cgt
+                elif n == 1:
+                    return qm.callTable(None, lastcmp, [oldy[0], oldx[0], QBLIntObject(0), QBLIntObject(0)]).value[0]
+                qm.startHedge()
+                ret = qm.callTable(None, cmptbl, [oldy[0], oldx[0], QBLIntObject(0), QBLIntObject(0)]).value
+                nm -= 1
+            else:
+                remi = x.value >> n
+                if remi < 0:
+                    return clt
+                elif 0 < remi:
+                    return cgt
+                ret = [bit0, bit0]
+                qm.startHedge()
+            for i in range(nm, -1, -1):
+                ret = qm.callTable(None, lastcmp if i == 0 else cmptbl, [oldx[i], oldy[i], ret[0], ret[1]]).value
+            qm.endHedge()
+            return ret[0]
+        
+        if not (iwx and iwy):
+            return NotImplemented
+        nx = len(x.value)
+        ny = len(y.value)
+        if nx < ny:
+            x = self.extend(x.objtype, ny, x)
+            n = ny
+        elif ny < nx:
+            y = self.extend(y.objtype, nx, y)
+            n = nx
+        else:
+            n = nx
+        nm = n - 1
+        if x.objtype.signed:
+            if y.objtype.signed:
+                if n == 1:
+                    return qm.callTable(None, lastcmp, [y.value[0], x.value[0], QBLIntObject(0), QBLIntObject(0)]).value[0]
+                qm.startHedge()
+                ret = qm.callTable(None, cmptbl, [y.value[0], x.value[0], QBLIntObject(0), QBLIntObject(0)]).value
+            else:
+                if n == 1:
+                    if incleq:
+                        return bit1
+                    return qm.callTable(None, tbls['or2bit'], [x.value[0], y.value[0]]).value[0]
+                qm.startHedge()
+                ret = [qm.callTable(None, tbls['or2bit'], [x.value[nm], y.value[nm]]).value[0], bit0]
+            nm -= 1
+        else:
+            if y.objtype.signed:
+                if n == 1:
+                    if incleq:
+                        return qm.callTable(None, tbls['nor2bit'], [x.value[0], y.value[0]]).value[0]
+                    return bit0
+                qm.startHedge()
+                ret = [bit0, qm.callTable(None, tbls['or2bit'], [x.value[nm], y.value[nm]]).value[0]]
+                nm -= 1
+            else:
+                ret = [bit0, bit0]
+                qm.startHedge()
+        for i in range(nm, -1, -1):
+            ret = qm.callTable(None, lastcmp if i == 0 else cmptbl, [x.value[i], y.value[i], ret[0], ret[1]]).value
+        qm.endHedge()
+        return ret[0]
+    
 class QBData:
+    __slots__ = ('qbidx', 'compridx', 'arrstep', 'isinput', 'isoutput')
+    
     def __init__(self, qbidx):
         self.qbidx = qbidx
         self.compridx = None
@@ -612,6 +1148,8 @@ class QBData:
         return 'QBData(qbidx = %d, arrstep = %s,  isinput = %s, isoutput = %s)' % (self.qbidx, str(self.arrstep), str(self.isinput), str(self.isoutput))
     
 class QLStep:
+    __slots__ = ('typeid', 'arrqb', 'nqb', 'nbase', 'id')
+    
     def __init__(self, typeid, arrqb):
         self.typeid = typeid
         self.arrqb = arrqb
@@ -629,6 +1167,8 @@ class QLStep:
         self.nbase = 1<<self.nqb
         
 class StepQBInit(QLStep):
+    __slots__ = ('state', 'evalstate')
+    
     def __init__(self, arrqb, state):
         super().__init__('INIT', arrqb)
         if type(state) == int:
@@ -638,11 +1178,19 @@ class StepQBInit(QLStep):
                 self.state = [ComplexValue(), ComplexValue(real = RationalValue('INT', 1))]
         else:
             self.state = state
+        self.evalstate = None
+        
+    def getEvalState(self):
+        if self.evalstate is None:
+            self.evalstate = evalCplxArray(self.state)
+        return self.evalstate
         
     def __str__(self):
         return 'qbinit(%s, {%s})' % (str(self.arrqb), ', '.join([str(int2word(k, self.nqb)) + ' : ' + str(self.state[k]) for k in range(self.nbase)]))
     
 class StepApplyTbl(QLStep):
+    __slots__ = ('nin', 'nout', 'arrqbin', 'arrqbout', 'arrcopy', 'tbl')
+    
     def __init__(self, arrqbin, arrqbout, arrcopy, tbl):
         super().__init__('APPTBL', list(set(arrqbin + arrqbout)))
         self.nin = len(arrqbin)
@@ -679,14 +1227,24 @@ class StepApplyTbl(QLStep):
                       ',\n   '.join([str(int2word(i, self.nin)) + ' : ' + str(int2word(self.tbl[i], self.nout)) for i in range(len(self.tbl))]))
     
 class StepApplyOp(QLStep):
+    __slots__ = ('opmatr', 'evalmatr')
+    
     def __init__(self, arrqb, opmatr):
         super().__init__('APPOP', arrqb)
         self.opmatr = opmatr
+        self.evalmatr = None
+    
+    def getEvalMatr(self):
+        if self.evalmatr is None:
+            self.evalmatr = evalCplxArray(self.opmatr)
+        return self.evalmatr
     
     def __str__(self):
         return '''applyop(%s,\n  [%s])''' % (str(self.arrqb), 
                       ',\n   '.join([ ', '.join([str(self.opmatr[i][k]) for k in range(self.nbase)]) for i in range(self.nbase)]))
 class Hedge:
+    __slots__ = ('parent', 'arrchld', 'startidx', 'endidx')
+    
     def __init__(self, parent):
         self.parent = parent
         self.arrchld = []
@@ -700,6 +1258,8 @@ class Hedge:
             return 'Hedge(startidx=' + str(self.startidx) + ', endidx=' + str(self.endidx) + ')'
         
 class StepHedgeStart(QLStep):
+    __slots__ = ('hedge',)
+    
     def __init__(self, hedge):
         super().__init__('HDGSTART', [].copy())
         self.hedge = hedge
@@ -708,6 +1268,8 @@ class StepHedgeStart(QLStep):
         return 'starthedge()'
 
 class StepHedgeEnd(QLStep):
+    __slots__ = ()
+    
     def __init__(self, hedge):
         super().__init__('HDGEND', [].copy())
         
@@ -719,9 +1281,15 @@ class QuantumLogic:
         self.impsrcpath = []
         self.imppath = imppath
         self.impsyspath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qbl')
-        self.globalfr={}
+        self.globalfr = Frame()
         self.arrfr = [self.globalfr]
+        self.nextra = 0 #number of names bound outside the scope layouts of non-global frames
         self.callstack = []
+        self.neffects = 0 #counts the effects of calls preventing their memoization
+        self.memo = {}
+        self.maxmemo = maxmemo
+        self.tblcache = {} #analyzed table function calls by function and argument pattern
+        self.modules = {} #imported sources by resolved path, importing them again does nothing
 
         self.setGlobal('objtype', QBLObjectType.ObjType)
         self.setGlobal('function', QBLObjectType.Function)
@@ -780,10 +1348,45 @@ class QuantumLogic:
         self.arrout = []
         self.roothdg = Hedge(None)
         self.currhdg = self.roothdg
+        self.simstate = None
         
         for pl in preload:
             self.importSrc(pl, None, sysonly = True)
+        if len(preload) > 0:
+            self.addNativeFuncs()
             
+    def clone(self):
+        # Returns a new logic with the globals and functions of this one, without preloading the sources again.
+        # Meant for a prototype, which has only been preloaded: its qubits and steps aren't copied.
+        if len(self.arrqb) > 0 or len(self.arrstep) > 0:
+            raise Exception('Only a logic without qubits and steps can be cloned')
+        ret = QuantumLogic(imppath = self.imppath, preload = [])
+        names = ret.globalfr.names
+        copies = {} #globals sharing a list share its copy too
+        for name, storage in self.globalfr.names.items():
+            value = storage.value
+            if value != None and value.objtype is QBLObjectType.FuncList:
+                #script and table functions are shared, internal ones are bound to their logic
+                store = names.get(name)
+                if store == None:
+                    funclist = QBLFuncListObject(name)
+                    names[name] = Storage(0, value = funclist, isFixed = True)
+                else:
+                    funclist = store.value
+                for nargs, func in value.value.items():
+                    if isinstance(func, QBLNativeFunc):
+                        func = func.fallback
+                    elif func.functype == 'INTERNAL':
+                        continue
+                    funclist.value[nargs] = func
+            elif not storage.isFixed or name not in names:
+                names[name] = Storage(0, value = copyMemoValue(value, copies), isFixed = storage.isFixed)
+        ret.addNativeFuncs()
+        ret.memo = self.memo.copy()
+        ret.tblcache = self.tblcache #depends only on the table definitions
+        ret.modules = self.modules.copy()
+        return ret
+        
     def raiseRuntimeError(self, pos, msg):
         raise QBLRuntimeError(pos, msg, callstack = self.callstack)
         
@@ -794,6 +1397,7 @@ class QuantumLogic:
         self.raiseRuntimeError(pos, 'assignment target should be either a name or element(s) of an array')
         
     def importSrc(self, impname, startpos, sysonly = False):
+        self.neffects += 1
         if sysonly:
             arrpath = [self.impsyspath]
         else:
@@ -810,15 +1414,40 @@ class QuantumLogic:
                 srcfile = testpath
                 break
         if srcfile != None:
-            self.compileSource(srcfile = srcfile)
+            modkey = os.path.realpath(srcfile)
+            if modkey in self.modules:
+                return
+            #registered before compiling, so that circular imports end
+            self.modules[modkey] = srcfile
+            try:
+                self.compileSource(srcfile = srcfile)
+            except Exception:
+                del self.modules[modkey]
+                raise
         else:
             self.raiseRuntimeError(startpos, impname + " couldn't be found in search path")
     
+    def loadTableFile(self, cmd):
+        # Definition of the table function cmd reading its table from a file, which holds a one dimensional
+        # .npy array of non-negative integers, the output for each input. The path is relative to the source of cmd.
+        srcfile = cmd.startpos.srcfile
+        path = os.path.join(os.path.dirname(srcfile), cmd.tblfile) if srcfile != None else cmd.tblfile
+        if not path.lower().endswith('.npy'):
+            self.raiseRuntimeError(cmd.startpos, 'table file %s should be a .npy file' % cmd.tblfile)
+        requireNumpy('reading table file %s' % cmd.tblfile)
+        try:
+            values = np.load(path, allow_pickle = False)
+        except (OSError, ValueError) as e:
+            self.raiseRuntimeError(cmd.startpos, "table file %s couldn't be read: %s" % (cmd.tblfile, str(e)))
+        if values.ndim != 1 or values.dtype.kind not in 'iu' or (len(values) > 0 and values.min() < 0):
+            self.raiseRuntimeError(cmd.startpos, 'table file %s should hold a one dimensional array of non-negative integers' % cmd.tblfile)
+        return CmdFuncDef(cmd.startpos, cmd.endpos, 'TABLE', cmd.nametok, None, tableBody(dict(enumerate(values.tolist()))))
+        
     def setGlobal(self, name, value):
-        self.globalfr[name] = Storage(
+        self.globalfr.bind(name, Storage(
             0,
             value = value,
-            isFixed = True)   
+            isFixed = True))
         
     def setValue(self, target, value, startpos, tgtidx = None):
         if tgtidx == None:
@@ -831,13 +1460,15 @@ class QuantumLogic:
                 self.raiseRuntimeError(startpos, 'index %d out of range' % tgtidx)
             tgtarr[tgtidx] = value
     
-    def addFrame(self):
-        ret = {}
+    def addFrame(self, scope = None):
+        ret = Frame(scope)
         self.arrfr.append(ret)
         return ret
     
     def rmFrame(self):
-        self.arrfr.pop()
+        frame = self.arrfr.pop()
+        if frame.names:
+            self.nextra -= len(frame.names)
     
     def setupTarget(self, name, local):
         storage = self.lookupName(name, None)
@@ -846,19 +1477,49 @@ class QuantumLogic:
             storage = None
         if storage == None:
             storage = Storage(curridx, isFixed = False)
-            self.arrfr[curridx][name] = storage
+            frame = self.arrfr[curridx]
+            if curridx > 0 and name not in frame.layout:
+                localnames.add(name)
+                if name not in frame.names:
+                    self.nextra += 1
+            frame.bind(name, storage)
         return storage
     
-    def lookupName(self, name, errorpos = None):
-        for i in range(len(self.arrfr)-1, -1, -1):
-            frame=self.arrfr[i]
-            if name in frame: return frame[name]
+    def lookupName(self, name, errorpos = None, top = None):
+        if top == None:
+            top = len(self.arrfr)-1
+        for i in range(top, -1, -1):
+            storage = self.arrfr[i].get(name)
+            if storage != None: return storage
         if errorpos != None:    
             self.raiseRuntimeError(errorpos, "name '%s' is not found" % name)
         else:
             return None 
+        
+    def findName(self, name, chain, nscope, errorpos = None):
+        #Looks up name referenced from a lexical scope, chain and nscope are the results of Scope.resolve
+        arrfr = self.arrfr
+        if self.nextra == 0:
+            for fridx, idx in chain:
+                storage = arrfr[fridx].slots[idx]
+                if storage is not None:
+                    return storage
+            if name not in localnames:
+                storage = self.globalfr.names.get(name)
+                if storage is None and errorpos != None:
+                    self.raiseRuntimeError(errorpos, "name '%s' is not found" % name)
+            else:
+                storage = self.lookupName(name, errorpos, top = len(arrfr)-1-nscope)
+        else:
+            storage = self.lookupName(name, errorpos)
+        if storage is not None and not storage.isFixed:
+            #the variable is outside the scopes of the function
+            self.neffects += 1
+        return storage
 
     def addFunc(self, func):
+        self.neffects += 1
+        self.memo.clear()
         store = self.lookupName(func.name)
         if store != None:
             funclist = store.value
@@ -866,14 +1527,35 @@ class QuantumLogic:
                 self.raiseRuntimeError(func.cmd.startpos, 'name %s was already defined as a non-function list object, function cannot be added' %  func.name)
         else:
             funclist = QBLFuncListObject(func.name)
-            self.arrfr[0][func.name] = Storage(0, value = funclist, isFixed = True)
+            self.globalfr.bind(func.name, Storage(0, value = funclist, isFixed = True))
                  
         funcs = funclist.value
-        if func.nargs in funcs and funcs[func.nargs].functype == 'INTERNAL':
+        if func.nargs in funcs and funcs[func.nargs].functype == 'INTERNAL' and not isinstance(funcs[func.nargs], QBLNativeFunc):
             self.raiseRuntimeError(func.cmd.startpos, 'function %s with %d arguments is internal, cannot be overriden' %  (func.name,  func.nargs))
         funclist.value[func.nargs] = func
             
+    def addNativeFuncs(self):
+        #Replaces the functions of the base library having native implementations, keeping them as fallback
+        basefile = os.path.join(self.impsyspath, 'base.qbl')
+        for native in [
+            QBLNativeAddSub(self, True),
+            QBLNativeAddSub(self, False),
+            QBLNativeMul(self),
+            QBLNativeIfElse(self),
+            QBLNativeEqual(self, True),
+            QBLNativeEqual(self, False),
+            QBLNativeLessThan(self, '<', False, False),
+            QBLNativeLessThan(self, '<=', False, True),
+            QBLNativeLessThan(self, '>', True, False),
+            QBLNativeLessThan(self, '>=', True, True)
+        ]:
+            func = native.getFunc(native.name, native.nargs)
+            if func != None and func.functype == 'SCRIPT' and func.cmd.startpos.srcfile == basefile:
+                native.fallback = func
+                self.globalfr.get(native.name).value.value[native.nargs] = native
+            
     def allocQBit(self, idx = None):
+        self.neffects += 1
         if idx == None: idx = self.freeidx
         if idx<0: return None
         lqb = len(self.arrqb)
@@ -907,8 +1589,14 @@ class QuantumLogic:
                     return QBLQBitObject(newidx)
             else:
                 self.arrqb[obj.value].isoutput = True
-        elif objcls in ['WORD', 'LIST']:
-            if objcls == 'LIST' and not reindex:
+        elif objcls == 'WORD':
+            if reindex:
+                obj.value = obj.value.replaceQubit(oldidx, newidx)
+            else:
+                for qbidx in obj.value.qubits():
+                    self.arrqb[qbidx].isoutput = True
+        elif objcls == 'LIST':
+            if not reindex:
                 obj = QBLListObject(obj.value.copy())
             for i in range(len(obj.value)):
                 qb = obj.value[i]
@@ -928,6 +1616,7 @@ class QuantumLogic:
                     self.freeidx = i
     
     def comprQBits(self):
+        self.simstate = None
         self.arrqbcompr = []
         for qbdata in self.arrqb:
             if qbdata != None:
@@ -935,6 +1624,9 @@ class QuantumLogic:
                 self.arrqbcompr.append(qbdata)
     
     def addStep(self, qmstep):
+        self.simstate = None
+        if qmstep.typeid != 'HDGSTART': #an empty hedge is deleted at its end
+            self.neffects += 1
         stepidx = len(self.arrstep)
         qmstep.id = stepidx
         for qbidx in qmstep.arrqb:
@@ -952,6 +1644,7 @@ class QuantumLogic:
         qbdata.arrstep.pop(qbdata.arrstep.index(stepidx))
     
     def delStep(self, stepidx):
+        self.simstate = None
         step = self.arrstep[stepidx]
         for qbidx in step.arrqb:
             self.popStepQB(stepidx, qbidx)
@@ -978,6 +1671,7 @@ class QuantumLogic:
         self.currhdg = self.currhdg.parent 
         
     def delLastHedge(self, hedge):
+        self.simstate = None
         self.arrstep[hedge.startidx] = None
         if hedge.endidx != None:
             self.arrstep[hedge.endidx] = None
@@ -1017,10 +1711,12 @@ class QuantumLogic:
             elif tgtclass == 'INT':
                 return QBLIntObject(srcobj.value)
             elif tgtclass == 'STRWORD':
+                if tgttype.bitstruct == None:
+                    return QBLWordObject(tgttype.signed, QBLWordBits(tgttype.nbits, srcobj.value))
                 rb = range(tgttype.nbits)
                 bitlst = [srcobj.value if i == 0 else 0 for i in rb]
                 for i in rb:
-                    bitlst[i] = QBLBitObject(bitlst[i]) if tgttype.bitstruct == None or tgttype.bitstruct[i] == QBLObjectType.Bit else self.bit2qbit(bitlst[i])
+                    bitlst[i] = QBLBitObject(bitlst[i]) if tgttype.bitstruct[i] == QBLObjectType.Bit else self.bit2qbit(bitlst[i])
                 return QBLWordObject(tgttype.signed, bitlst)
         
         elif srcclass == 'QBIT':
@@ -1048,9 +1744,11 @@ class QuantumLogic:
                 rb = range(tgttype.nbits)
                 if (srcobj.value>>tgttype.nbits) not in [0, -1]:
                     return None
+                if tgttype.bitstruct == None:
+                    return QBLWordObject(tgttype.signed, QBLWordBits(tgttype.nbits, srcobj.value & ((1 << tgttype.nbits) - 1)))
                 bitlst = int2word(srcobj.value, tgttype.nbits)
                 for i in rb:
-                    bitlst[i] = QBLBitObject(bitlst[i]) if tgttype.bitstruct == None or tgttype.bitstruct[i] == QBLObjectType.Bit else self.bit2qbit(bitlst[i])
+                    bitlst[i] = QBLBitObject(bitlst[i]) if tgttype.bitstruct[i] == QBLObjectType.Bit else self.bit2qbit(bitlst[i])
                 return QBLWordObject(tgttype.signed, bitlst)
         
         elif srcclass == 'LIST':
@@ -1071,6 +1769,8 @@ class QuantumLogic:
                         tbtype = QBLObjectType.QBit
                     else:
                         tbtype = QBLObjectType.Bit
+                    if val.objtype is tbtype:
+                        continue
                     newbit = self.cast(tbtype, bitlst[i])
                     if newbit == None: return None
                     bitlst[i] = newbit
@@ -1082,414 +1782,108 @@ class QuantumLogic:
                 if retval == None: return None
                 else: return QBLIntObject(retval)
             elif tgtclass in ['WORD', 'STRWORD']:
-                srclen = len(srcobj.value)
+                srcbits = srcobj.value
+                srclen = len(srcbits)
                 if tgtclass == 'STRWORD':
                     strtgt = tgttype.bitstruct != None
                     qutgt = False
                     tgtlen = tgttype.nbits
-                    enlarge = tgtlen > srclen
                 else:
                     strtgt = False
                     qutgt = tgttype.allquantum
-                    enlarge = False
                     tgtlen = srclen
                 
-                if enlarge:
-                    bitlst = srcobj.value.copy()
-                    extbit = srcobj.value[srclen - 1] if srctype.signed else QBLBitObject(0)
-                    for i in range(srclen, tgtlen):
-                        bitlst.append(extbit)
-                else:
+                if tgtlen < srclen:
                     if srctype.signed:
-                        extbit = srcobj.value[tgtlen - 1]
+                        extbit = srcbits[tgtlen - 1]
                     else:
                         extbit = QBLBitObject(0)
                     for i in range(tgtlen, srclen):
-                        if srcobj.value[i] != extbit:
+                        if srcbits[i] != extbit:
                             return None
-                    bitlst = srcobj.value[0:tgtlen] 
-                for i in range(0, tgtlen):
-                    sb = bitlst[i]
-                    sbtype = sb.objtype.value
-                    if strtgt:
-                        tbtype = tgttype.bitstruct[i].value
-                    elif qutgt:
-                        tbtype = 'QBIT'
-                    else:
-                        tbtype = sbtype
-                        
-                    if tbtype != sbtype:
-                        if tbtype == 'BIT': return None
+                bits = srcbits.resize(tgtlen, srctype.signed)
+                if strtgt or (qutgt and bits.qmask != (1 << tgtlen) - 1):
+                    bitlst = list(bits)
+                    for i in range(0, tgtlen):
+                        sb = bitlst[i]
+                        sbtype = sb.objtype.value
+                        if strtgt:
+                            tbtype = tgttype.bitstruct[i].value
                         else:
-                            bitlst[i] = self.bit2qbit(sb)
+                            tbtype = 'QBIT'
+                            
+                        if tbtype != sbtype:
+                            if tbtype == 'BIT': return None
+                            else:
+                                bitlst[i] = self.bit2qbit(sb.value)
+                    bits = bitlst
                         
-                return QBLWordObject(tgttype.signed, bitlst)
+                return QBLWordObject(tgttype.signed, bits)
             elif tgtclass == 'LIST':
-                return QBLListObject(srcobj.value.copy())
+                return QBLListObject(list(srcobj.value))
             
         return None
         
     def compileExpr(self, expr, nullable = False, isTarget = False):
-        if isTarget and (expr.typeid != 'EXPFUNC' or expr.name != '#ELEMENT'):
-            self.raiseTargetError(expr.startpos)
-            
-        if expr.typeid == 'EXPCONS':
-            ret = expr.obj
-            
-        elif expr.typeid == 'EXPNAME':
-            storage = self.lookupName(expr.name, errorpos = expr.startpos)
-            if storage.value == None:
-                self.raiseRuntimeError(expr.startpos, "variable %s is uninitialized and shouldn't be referenced" %  expr.name)
-            ret = storage.value
-            
-        elif expr.typeid == 'EXPFUNC':
-            qual = ( expr.name == '#QUALIFY' )
-            elmt = ( expr.name == '#ELEMENT' )
-            isarr = ( expr.name == '#ARRAY' )
-            nargs = len(expr.arrarg)
-            docast = False
-            ret = None
-            if qual or elmt or isarr: 
-                idobj = None
-            else:
-                if expr.idexp != None:
-                    idobj = self.compileExpr(expr.idexp)
-                else:
-                    idobj = self.lookupName(expr.name, errorpos = expr.startpos).value
-                if idobj.objtype not in [None, QBLObjectType.FuncList,  QBLObjectType.Function]: 
-                    self.raiseRuntimeError(idexp.startpos, "Object %s shouldn't be called as a function" % str(ret))
-                if idobj.objtype == QBLObjectType.FuncList:
-                    try:
-                        idobj = idobj.value[nargs]
-                    except KeyError:
-                        self.raiseRuntimeError(expr.idexp.startpos, 'function %s is not defined for %d arguments, only for %s' % (
-                            idobj.name,
-                            nargs,
-                            ', '.join([str(n) for n in idobj.value])
-                        ))
-                elif idobj.objtype == None:
-                    if nargs != 1:
-                        self.raiseRuntimeError(expr.startpos, "casting to object type %s needs exactly one argument" % str(idobj))
-                    docast = True
-                               
-            args = [self.compileExpr(expr.arrarg[i]) for i in range(nargs)]
-                
-            if qual:
-                baseobj = args[0]
-                if baseobj.getType() != QBLObjectType.ObjType or baseobj.value != 'WORD':
-                    self.raiseRuntimeError(expr.startpos, "%s shouldn't be qualified with {}" % str(args[0]))
-                
-                idxarg = args[1]
-                argtype = idxarg.getType()
-                if argtype == QBLObjectType.Int:
-                    if idxarg.value>0:
-                        ret = QBLStructuredWordType(baseobj, idxarg.value)
-                elif argtype == QBLObjectType.List:
-                    bitsok = (len(idxarg.value)>0)
-                    bits = []
-                    for e in idxarg.value:
-                        if e == None:
-                            self.raiseRuntimeError(expr.arrarg[1].startpos, 'qualifer should be a fully initialized array')
-                        elif e not in [QBLObjectType.Bit, QBLObjectType.QBit]:
-                            bitsok = False
-                            break
-                        bits.append(e)     
-                    if bitsok:
-                        ret = QBLStructuredWordType(baseobj, bits)
-                if ret == None:    
-                    self.raiseRuntimeError(expr.arrarg[1].startpos, 'a positive integer or an array of bit types is expected as qualifier')
-                    
-            elif elmt:
-                arridx = None
-                isidxarr = False
-                baseobj = args[0]
-                if baseobj != QBLObjectType.QBit and not baseobj.getType().hasElements:
-                    self.raiseRuntimeError(expr.arrarg[1].startpos, "object of type %s doesn't provide elements" % str(baseobj.getType()))
-                if nargs == 2:
-                    idxarg = args[1]
-                    argtype = idxarg.getType()
-                    if argtype == QBLObjectType.Int or argtype == QBLObjectType.Str:
-                        arridx = idxarg.value
-                    elif argtype == QBLObjectType.List:
-                        isidxarr = True
-                        idxsok = (len(idxarg.value)>0)
-                        idxs = []
-                        for e in idxarg.value:
-                            if e == None:
-                                self.raiseRuntimeError(expr.arrarg[1].startpos, "index array shouldn't contain uninitialized element")
-                            elif e.objtype != QBLObjectType.Int:
-                                self.raiseRuntimeError(expr.arrarg[1].startpos, 'indices should be integers or array of integers')
-                            idxs.append(e.value)     
-                        
-                        arridx = idxs                        
-                else:
-                    self.raiseRuntimeError(expr.startpos, 'multiindices are not allowed') #shouldn't arrive here though
-                    
-                if arridx == None:
-                    self.raiseRuntimeError(expr.startpos, 'index value cannot be empty') 
-                else:
-                    if isidxarr:
-                        retval = []
-                        idxs = arridx
-                    else:
-                        idxs = [arridx]
-                    if isTarget:
-                        if baseobj.getType() != QBLObjectType.List:
-                            self.raiseTargetError(expr.startpos)
-                        return (baseobj, arridx)
-                    for i in idxs:
-                        try:
-                            value = baseobj[i]
-                            idxok = True
-                        except IndexError:
-                            idxok = False
-                        except KeyError:
-                            idxok = False
-                        if not idxok:
-                            self.raiseRuntimeError(expr.arrarg[1].startpos, "there isn't any element for index %s" % str(s))
-                        if value == None:
-                            self.raiseRuntimeError(expr.startpos, "shouldn't refer to uninitialized element")
-                        if isidxarr:
-                            retval.append(value)
-                        else:
-                            ret = value
-                            
-                    if isidxarr:
-                        ret = QBLListObject(value = retval)
-                            
-            elif isarr:
-                ret = QBLListObject(args)
-            
-            elif docast:
-                ret =  self.cast(idobj, args[0])
-                if ret == None:
-                    self.raiseRuntimeError(expr.startpos, "object %s with type %s cannot be converted to type %s" % (str(args[0]), str(args[0].getType()), str(idobj)))
-            else:
-                if nargs != idobj.nargs:
-                    self.raiseRuntimeError(expr.startpos, "function '%s' requires %d arguments but found %d" % (idobj.name, idobj.nargs, nargs))
-                if idobj.functype == 'INTERNAL':
-                    try:
-                        ret = idobj.call(args)
-                    except QBLRuntimeError as e:
-                        self.raiseRuntimeError(expr.startpos, e.desc)
-                        
-                elif idobj.functype == 'SCRIPT':
-                    self.callstack.append(expr)
-                    funcfr = self.addFrame()
-                    currfr = len(self.arrfr)-1
-                    for i in range(idobj.nargs):
-                        funcfr[idobj.cmd.args[i].name] = Storage(currfr, value = args[i], isFixed = False)
-                    for bcmd in idobj.cmd.body:
-                        ret = self.compileCommand(bcmd)
-                        if ret != None:
-                            ret = ret[0]
-                            break
-                    self.rmFrame()
-                    self.callstack.pop()
-                    
-                elif idobj.functype == 'TABLE':
-                    qbitdict = {}
-                    cbits = []
-                    cbitidxs = []
-                    cval = 0 #cval will contain the classical input value
-                    for i in range(nargs):
-                        arg = args[i]
-                        if arg.getType() == QBLObjectType.QBit: #If the arg is a qubit, we store it's reference
-                            key = arg.value
-                            if key in qbitdict:
-                                qbitdict[key].append(i)
-                            else:
-                                qbitdict[key] = [i]
-                        else:
-                            bitval = self.cast(QBLObjectType.Bit, arg)
-                            if bitval == None or bitval.value not in [0,1]:
-                                self.raiseRuntimeError(expr.startpos, "table function '%s' requires a qbit or 0 or 1, but got %s for argument %d" % (idobj.name, str(args[i]), i))
-                            cbits.append(bitval.value)
-                            cval += bitval.value<<i
-                            cbitidxs.append(i)
-                    
-                    nin = len(qbitdict)
-                    rin = range(nin)
-                    nout = idobj.cmd.body[1]
-                    rout = range(nout)
-                    truthtbl = idobj.cmd.body[2]
-                    if nin == 0: 
-                        outval = truthtbl[cval]
-                        ret = [QBLBitObject((outval>>i)&1) for i in rout]
-                    else:
-                        invecs = [0 for i in rin]
-                        outvecs = [0 for i in rout]
-                        nitem = 1<<nin
-                        ritem = range(nitem)
-                        outvals = [0 for i in ritem]
-                        arrqbin = [qb for qb in qbitdict]
-                        copyins = [True for i in rin]
-                        for i in ritem:
-                            key = cval
-                            for k in rin:
-                                bitval = (i >> k) & 1
-                                invecs[k] |= bitval << i
-                                for l in qbitdict[arrqbin[k]]:
-                                    key = key | (bitval << l)
-                            outval = truthtbl[key]
-                            outvals[i] = outval
-                            for k in rout:
-                                outvecs[k] |= ((outval>>k)&1)<<i
-                        
-                        #Check const outputs or whether the output matches any other input or output
-                        cons1 = (1<<nitem)-1
-                        mask = 0
-                        idx = 0
-                        ret = [None for i in rout]
-                        retmap = [i for i in rout]
-                        arrqbout = [] 
-                        for i in rout:
-                            newmask = mask<<1 | 1
-                            outvec = outvecs[idx]
-                            iscons = outvec in [0, cons1]
-                            isinp = outvec in invecs
-                            issame = outvec in outvecs[0:idx]
-                            if iscons or issame or isinp:
-                                for k in ritem:
-                                    outval = outvals[k]
-                                    outvals[k] = mask & outval | ((~newmask & outval)>>1)
-                                outvecs.pop(idx)
-                                retmap.pop(idx)
-                                if iscons:
-                                    ret[i] = bool2bit(outvec != 0)
-                                elif isinp:
-                                    inpidx = invecs.index(outvec)
-                                    ret[i] = QBLQBitObject(arrqbin[inpidx]) 
-                                else:
-                                    ret[i] = ret[outvecs.index(outvec)]
-                            else:
-                                idx += 1
-                                mask = newmask
-                                qbidx = self.allocQBit()
-                                ret[i] = QBLQBitObject(qbidx)
-                                arrqbout.append(qbidx)
-                        nout = len(outvecs)
-                        rout = range(nout)
-                        
-                        if nout>0:
-                            self.addStep(StepApplyTbl(arrqbin, arrqbout, copyins, outvals))
-                    ret = QBLListObject(ret)
-                else: 
-                    self.raiseImplError(expr.startpos)
-                
-            if not nullable and ret == None:
-                self.raiseRuntimeError(expr.startpos, "function %s expected to return a value, but it didn't" % idobj.name)
-                
-        elif expr.typeid == 'EXPDICT':
-            dictobj = []
-            ret = QBLDictObject(expr.nbits, {i : self.compileExpr(expr.dictexp[i]) for i in expr.dictexp })
-                
-        else:
-            self.raiseImplError(expr.startpos)
-
-        return ret
+        return lowerExpr(expr, nullable, isTarget)(self)
             
     def compileCommand(self, cmd):
-        if cmd.typeid == 'IMPORT':
-            self.importSrc(cmd.impname, cmd.startpos)
-            
-        elif cmd.typeid == 'CMDCALC':
-            for i in range(len(cmd.tgtarr)):
-                tgtexp = cmd.tgtarr[i]
-                evalexp = cmd.evalarr[i]
-                if(evalexp != None):
-                    value = self.compileExpr(evalexp, nullable = (tgtexp == None))
-                else:
-                    value = None
-
-                if tgtexp != None:
-                    expr = tgtexp
-                    if expr.typeid == 'EXPNAME':
-                        storage = self.setupTarget(expr.name, cmd.local)
-                        if value != None:                            
-                            self.setValue(storage, value, tgtexp.startpos)
-                    else:
-                        tgtobj, tgtidx = self.compileExpr(tgtexp, isTarget = True)
-                        tgtarr = tgtobj.value
-                        if type(tgtidx) == list:
-                            valtyp = value.getType()
-                            if valtyp.value != 'LIST':
-                                self.raiseRuntimeError(evalexp.startpos, 'when assigning to multiple array elements, the value should be also an array')
-                            valarr = value.value
-                            lenidx = len(tgtidx)
-                            if lenidx != len(valarr):
-                                self.raiseRuntimeError(cmd.startpos, 'target array indexes are not matching with source array length')
-                        else:
-                            valarr = [value]
-                            tgtidx = [tgtidx]
-                            lenidx = 1
-
-                        tgttype = tgtobj.getType()
-                        for i in range(lenidx):
-                            self.setValue(tgtobj, valarr[i], tgtexp.startpos, tgtidx = tgtidx[i])
-                        
-        elif cmd.typeid == 'CMDFDEF':
-            self.addFunc(QBLFuncObject(cmd.name, cmd = cmd))
-        
-        elif cmd.typeid == 'CMDRET':
-            retval = self.compileExpr(cmd.retexp) if cmd.retexp != None else None
-            return [retval]
-            
-        elif cmd.typeid in ['CMDIF', 'CMDWHILE']:
-            while(True):
-                condvalue = self.compileExpr(cmd.condition)
-                condtype = condvalue.getType()
-                if condtype.value not in ['INT', 'BIT']:
-                    self.raiseRuntimeError(cmd.condition.startpos, 'condition should either int or bit type')
-                if condvalue.value != 0:
-                    if cmd.typeid == 'CMDIF':
-                        cmdtoexec = cmd.iftrue
-                    else:
-                        cmdtoexec = cmd.command
+        return lowerCommand(cmd)(self)
+        
+    def callTable(self, startpos, idobj, args):
+        nargs = len(args)
+        qbitdict = {}
+        qbitpos = {}
+        pattern = [] #index of the qubit among the inputs or -1-bit for classical arguments
+        cval = 0 #cval will contain the classical input value
+        for i in range(nargs):
+            arg = args[i]
+            if arg.getType() == QBLObjectType.QBit: #If the arg is a qubit, we store it's reference
+                key = arg.value
+                if key in qbitdict:
+                    qbitdict[key].append(i)
                 else:
-                    if cmd.typeid == 'CMDIF':
-                        cmdtoexec = cmd.iffalse
-                    else: break
-                if cmdtoexec != None:
-                    retval = self.compileCommand(cmdtoexec)
-                    if retval != None: return retval
-                if cmd.typeid == 'CMDIF': break
-                    
-        elif cmd.typeid == 'CMDFOR':
-            listobj = self.compileExpr(cmd.listexp)
-            if listobj.getType() != QBLObjectType.List:
-                self.raiseRuntimeError(cmd.listexp, 'can iterate a list only, instead found object with type '+str(listobj.getType()))
-            storage = self.setupTarget(cmd.varname, True)
-            for iterobj in listobj.value:
-                storage.value = iterobj
-                retval = self.compileCommand(cmd.command)
-                if retval != None: return retval
-                
-        elif cmd.typeid == 'CMDBLCK':
-            self.addFrame()
-            retval = None
-            for bcmd in cmd.arrcmd:
-                retval = self.compileCommand(bcmd)
-                if retval != None:
-                    break
-            self.rmFrame()
-            return retval
-        
-        else:
-            self.raiseImplError(cmd.startpos)
-            
-        return None
+                    qbitdict[key] = [i]
+                    qbitpos[key] = len(qbitpos)
+                pattern.append(qbitpos[key])
+            else:
+                bitval = self.cast(QBLObjectType.Bit, arg)
+                if bitval == None or bitval.value not in [0,1]:
+                    self.raiseRuntimeError(startpos, "table function '%s' requires a qbit or 0 or 1, but got %s for argument %d" % (idobj.name, str(args[i]), i))
+                cval += bitval.value<<i
+                pattern.append(-1 - bitval.value)
+        
+        tblkey = (idobj.cmd, tuple(pattern))
+        tblcall = self.tblcache.get(tblkey)
+        if tblcall == None:
+            tblcall = analyzeTblCall(idobj.cmd.body[1], idobj.cmd.body[2], cval, list(qbitdict.values()))
+            self.tblcache[tblkey] = tblcall
+        outvals, outdesc = tblcall
+        
+        arrqbin = list(qbitdict)
+        ret = []
+        arrqbout = []
+        for outtype, outval in outdesc:
+            if outtype == 'CONS':
+                ret.append(outval)
+            elif outtype == 'INP':
+                ret.append(QBLQBitObject(arrqbin[outval]))
+            elif outtype == 'SAME':
+                ret.append(ret[outval])
+            else:
+                qbidx = self.allocQBit()
+                ret.append(QBLQBitObject(qbidx))
+                arrqbout.append(qbidx)
+        if len(arrqbout) > 0:
+            self.addStep(StepApplyTbl(arrqbin, arrqbout, [True for qb in arrqbin], outvals.copy()))
+        return QBLListObject(ret)
         
+
     def compileSource(self, source=None, srcfile=None):
         if srcfile != None:
             self.impsrcpath.append(os.path.dirname(srcfile))
-        lexer=Lexer(source=source, srcfile=srcfile)
-        while True:
-            nextstm = parseCommand(lexer)
-            if nextstm != None:
-                self.compileCommand(nextstm)
-            else:
-                break
+        for cmd in parseSource(source = source, srcfile = srcfile):
+            self.compileCommand(cmd)
         if srcfile != None:
             self.impsrcpath.pop(-1)
         
@@ -1523,6 +1917,7 @@ class QuantumLogic:
         return cntreusedold
     
     def reduce(self, verbose = False):
+        self.simstate = None
         stepidx = len(self.arrstep) - 1
         cntunusednew = 0
         cntreusedold = 0
@@ -1668,6 +2063,7 @@ class QuantumLogic:
         iterdata = None,
         verbose = False):
 
+        self.simstate = None
         maxstidx = len(self.arrstep) - 1
         if maxstidx < 0:
             return
@@ -1828,6 +2224,7 @@ class QuantumLogic:
         self.cleanQBits()
 
     def unitarize(self, verbose = False):
+        self.simstate = None
         cntinpused = 0
         cntnewqb = 0
         for stepidx in range(len(self.arrstep)):
@@ -1920,6 +2317,10 @@ class QuantumLogic:
         ret = []
         self.getObjBits(qblobj, ret, iscompr)
         return ret
+
+    def evaluateClassical(self, inputs):
+        # inputs: one integer array for each input register, returns one array for each output register
+        return evalClassical(self, inputs)
               
     def getStat(self):
         ninit = 0
@@ -1991,6 +2392,148 @@ class QuantumLogic:
         
         return ret
 
+def getParserVersion():
+    # Hash of the modules defining the parsed trees, pickled trees of other versions are ignored
+    global parserversion
+    if parserversion == None:
+        h = hashlib.sha256()
+        pkgdir = os.path.dirname(os.path.abspath(__file__))
+        for modname in ['lexer.py', 'parser.py', 'types.py', 'lazyalg.py']:
+            with open(os.path.join(pkgdir, modname), 'rb') as f:
+                h.update(f.read())
+        parserversion = h.hexdigest()
+    return parserversion
+
+def getCachePath(srcfile):
+    return os.path.join(cachedir, hashlib.sha256(os.path.abspath(srcfile).encode('utf-8')).hexdigest() + '.pickle')
+
+def loadParsed(srcfile, stat):
+    # Parsed commands of srcfile from the on-disk cache, None if they aren't cached or are outdated
+    try:
+        with open(getCachePath(srcfile), 'rb') as f:
+            version, mtime, size, digest, parsed = pickle.load(f)
+        if version != getParserVersion():
+            return None
+        if mtime == stat.st_mtime_ns and size == stat.st_size:
+            return parsed
+        with open(srcfile, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == digest:
+                #touched but unchanged
+                storeParsed(srcfile, stat, digest, parsed)
+                return parsed
+    except Exception:
+        #a missing, stale or corrupt cache file is just a miss
+        pass
+    return None
+
+def storeParsed(srcfile, stat, digest, parsed):
+    path = getCachePath(srcfile)
+    tmppath = '%s.%d' % (path, os.getpid())
+    try:
+        os.makedirs(cachedir, exist_ok = True)
+        with open(tmppath, 'wb') as f:
+            pickle.dump((getParserVersion(), stat.st_mtime_ns, stat.st_size, digest, parsed), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+    except (OSError, pickle.PickleError, RecursionError):
+        #the cache is optional, parsing again next time is fine
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+
+def parseSource(source = None, srcfile = None):
+    # Yields the commands of a source string or file, parsing it only if it isn't cached in memory or on disk.
+    # Commands are yielded as they are parsed, so earlier commands run before a syntax error is reported.
+    if srcfile != None:
+        stat = os.stat(srcfile)
+        key = (srcfile, os.path.abspath(srcfile), stat.st_mtime_ns, stat.st_size)
+    else:
+        key = (None, source)
+    parsed = parsecache.pop(key, None)
+    if parsed == None and srcfile != None and cachedir != None:
+        parsed = loadParsed(srcfile, stat)
+    if parsed != None:
+        rememberParsed(key, parsed)
+        yield from parsed
+        return
+    if srcfile != None and cachedir != None:
+        with open(srcfile, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+    lexer = Lexer(source = source, srcfile = srcfile)
+    parsed = []
+    while True:
+        cmd = parseCommand(lexer)
+        if cmd == None:
+            break
+        parsed.append(cmd)
+        yield cmd
+    rememberParsed(key, parsed)
+    if srcfile != None and cachedir != None:
+        storeParsed(srcfile, stat, digest, parsed)
+
+def rememberParsed(key, parsed):
+    if maxparsed > 0:
+        if len(parsecache) >= maxparsed:
+            del parsecache[next(iter(parsecache))]
+        parsecache[key] = parsed
+
+def analyzeTblCall(nout, truthtbl, cval, qbitargs):
+    # Analyzes a table function call given the classical input value and the argument indices of each input qubit.
+    # Returns the table of the step applied (None without input qubits) and for each output whether it is a
+    # constant ('CONS', bit object), an input ('INP', input index), the same as a former output ('SAME', output
+    # index) or a new qubit ('NEW', None)
+    nin = len(qbitargs)
+    rin = range(nin)
+    rout = range(nout)
+    if nin == 0: 
+        outval = truthtbl[cval]
+        return None, [('CONS', QBLBitObject((outval>>i)&1)) for i in rout]
+    
+    invecs = [0 for i in rin]
+    outvecs = [0 for i in rout]
+    nitem = 1<<nin
+    ritem = range(nitem)
+    outvals = [0 for i in ritem]
+    for i in ritem:
+        key = cval
+        for k in rin:
+            bitval = (i >> k) & 1
+            invecs[k] |= bitval << i
+            for l in qbitargs[k]:
+                key = key | (bitval << l)
+        outval = truthtbl[key]
+        outvals[i] = outval
+        for k in rout:
+            outvecs[k] |= ((outval>>k)&1)<<i
+    
+    #Check const outputs or whether the output matches any other input or output
+    cons1 = (1<<nitem)-1
+    mask = 0
+    idx = 0
+    outdesc = []
+    for i in rout:
+        newmask = mask<<1 | 1
+        outvec = outvecs[idx]
+        iscons = outvec in [0, cons1]
+        isinp = outvec in invecs
+        issame = outvec in outvecs[0:idx]
+        if iscons or issame or isinp:
+            for k in ritem:
+                outval = outvals[k]
+                outvals[k] = mask & outval | ((~newmask & outval)>>1)
+            outvecs.pop(idx)
+            if iscons:
+                outdesc.append(('CONS', bool2bit(outvec != 0)))
+            elif isinp:
+                outdesc.append(('INP', invecs.index(outvec)))
+            else:
+                outdesc.append(('SAME', outvecs.index(outvec)))
+        else:
+            idx += 1
+            mask = newmask
+            outdesc.append(('NEW', None))
+    return outvals, outdesc
+
 def joinTblPair(step1, step2, maxinqb, maxoutqb):
     mask1 = (1<<step1.nin) - 1
     arrqbin = step1.arrqbin.copy()
@@ -2072,3 +2615,496 @@ def testVecs(invecs, outvecs):
             arrirr.append(i)
     return arrirr
         
+
+# Parsed tree nodes are lowered once into closures taking the QuantumLogic as argument,
+# all decisions depending only on the node (node type, special function names, child
+# nodes, number of arguments, slots of the names in the enclosing scopes) are made at
+# lowering time. The closures are cached on the nodes in node.lowered, a node is always
+# lowered within the same lexical scope, scope is None for the top level commands of sources.
+
+def lowerExpr(expr, nullable = False, isTarget = False, scope = None):
+    key = (nullable, isTarget)
+    func = expr.lowered.get(key)
+    if func == None:
+        func = lowerExprNode(expr, nullable, isTarget, scope)
+        expr.lowered[key] = func
+    return func
+
+def lowerCommand(cmd, scope = None):
+    func = cmd.lowered.get(None)
+    if func == None:
+        func = lowerCommandNode(cmd, scope)
+        cmd.lowered[None] = func
+    return func
+
+def lowerBody(cmd):
+    # Scope and lowered commands of a script function's body
+    body = cmd.lowered.get('BODY')
+    if body == None:
+        scope = Scope(cmd.body, args = [arg.name for arg in cmd.args])
+        argslots = [scope.slots[arg.name] for arg in cmd.args]
+        body = (scope, argslots, [lowerCommand(bcmd, scope) for bcmd in cmd.body])
+        cmd.lowered['BODY'] = body
+    return body
+
+def memoArgKey(obj):
+    # Hashable key of a classical argument value, None if the value isn't classical
+    if obj is None:
+        return None
+    objtype = obj.getType()
+    if objtype is QBLObjectType.Int or objtype is QBLObjectType.Bit or objtype is QBLObjectType.Str or objtype is QBLObjectType.ObjType:
+        return obj
+    if objtype is QBLObjectType.List:
+        ret = []
+        for e in obj.value:
+            key = memoArgKey(e)
+            if key is None:
+                return None
+            ret.append(key)
+        return tuple(ret)
+    if objtype.value == 'WORD':
+        if not isClassicalWord(obj):
+            return None
+        return (objtype, obj)
+    return None
+
+def memoKey(cmd, args):
+    # Key of a script function call in the memo of the logic, None if there are non-classical arguments
+    ret = [cmd]
+    for arg in args:
+        key = memoArgKey(arg)
+        if key is None:
+            return None
+        ret.append(key)
+    return tuple(ret)
+
+def copyMemoValue(obj, copies = None):
+    # Copies the mutable lists within a memoized return value. copies maps the id of each list already copied to its
+    # copy, so a list reached several times is copied only once and the copies share it the same way.
+    if obj is None:
+        return None
+    objtype = obj.objtype
+    if objtype is QBLObjectType.List or objtype is QBLObjectType.Dict:
+        if copies is None:
+            copies = {}
+        ret = copies.get(id(obj))
+        if ret is not None:
+            return ret
+        if objtype is QBLObjectType.List:
+            ret = QBLListObject([None] * len(obj.value))
+            keys = range(len(obj.value))
+        else:
+            ret = QBLDictObject(obj.nbits, {})
+            keys = list(obj.value)
+        copies[id(obj)] = ret
+        for key in keys:
+            ret.value[key] = copyMemoValue(obj.value[key], copies)
+        return ret
+    return obj
+
+def addListIds(obj, ids):
+    # Adds the ids of the lists and dicts reachable from obj to ids
+    if obj is None:
+        return
+    objtype = obj.objtype
+    if (objtype is QBLObjectType.List or objtype is QBLObjectType.Dict) and id(obj) not in ids:
+        ids.add(id(obj))
+        for e in (obj.value if objtype is QBLObjectType.List else obj.value.values()):
+            addListIds(e, ids)
+
+def sharesLists(ret, args):
+    # Whether a returned value contains a list or dict reachable from the arguments too
+    retids = set()
+    addListIds(ret, retids)
+    if len(retids) == 0:
+        return False
+    argids = set()
+    for arg in args:
+        addListIds(arg, argids)
+    return not retids.isdisjoint(argids)
+
+def lowerLookup(name, scope):
+    # Returns a function looking up name from within scope, raising an error at errorpos if not found
+    if scope == None:
+        def lookup(qm, errorpos):
+            return qm.lookupName(name, errorpos = errorpos)
+    else:
+        chain, nscope = scope.resolve(name)
+        def lookup(qm, errorpos):
+            return qm.findName(name, chain, nscope, errorpos)
+    return lookup
+
+def lowerTarget(name, local, scope):
+    # Returns a function setting up the storage of an assignment target name within scope
+    if scope == None:
+        def setup(qm):
+            return qm.setupTarget(name, local)
+        return setup
+    idx = scope.slots[name]
+    if local:
+        def setupLocal(qm):
+            frame = qm.arrfr[-1]
+            storage = frame.slots[idx]
+            if storage is None:
+                storage = Storage(len(qm.arrfr)-1, isFixed = False)
+                frame.slots[idx] = storage
+            return storage
+        return setupLocal
+    chain, nscope = scope.resolve(name)
+    def setupName(qm):
+        storage = qm.findName(name, chain, nscope)
+        if storage is None:
+            storage = Storage(len(qm.arrfr)-1, isFixed = False)
+            qm.arrfr[-1].slots[idx] = storage
+        return storage
+    return setupName
+
+def callScript(qm, expr, idobj, args):
+    nargs = len(args)
+    memokey = memoKey(idobj.cmd, args) if qm.maxmemo > 0 else None
+    memoret = qm.memo.pop(memokey, None) if memokey != None else None
+    if memoret != None:
+        qm.memo[memokey] = memoret
+        ret = copyMemoValue(memoret[0])
+    else:
+        neffects = qm.neffects
+        currhdg = qm.currhdg
+        funcscope, argslots, body = lowerBody(idobj.cmd)
+        qm.callstack.append(expr)
+        funcfr = qm.addFrame(funcscope)
+        currfr = len(qm.arrfr)-1
+        slots = funcfr.slots
+        for i in range(nargs):
+            slots[argslots[i]] = Storage(currfr, value = args[i], isFixed = False)
+        ret = None
+        for bfunc in body:
+            ret = bfunc(qm)
+            if ret != None:
+                ret = ret[0]
+                break
+        qm.rmFrame()
+        qm.callstack.pop()
+        if memokey != None and qm.neffects == neffects and qm.currhdg is currhdg and memoKey(idobj.cmd, args) == memokey and not sharesLists(ret, args):
+            #a call without effects, which didn't change its arguments either, returning only lists of its own
+            if len(qm.memo) >= qm.maxmemo:
+                del qm.memo[next(iter(qm.memo))]
+            qm.memo[memokey] = (copyMemoValue(ret),)
+    return ret
+
+def lowerExprNode(expr, nullable, isTarget, scope):
+    startpos = expr.startpos
+    if isTarget and (expr.typeid != 'EXPFUNC' or expr.name != '#ELEMENT'):
+        def evalTargetError(qm):
+            qm.raiseTargetError(startpos)
+        return evalTargetError
+        
+    if expr.typeid == 'EXPCONS':
+        obj = expr.obj
+        def evalConst(qm):
+            return obj
+        return evalConst
+        
+    elif expr.typeid == 'EXPNAME':
+        name = expr.name
+        lookup = lowerLookup(name, scope)
+        def evalName(qm):
+            storage = lookup(qm, startpos)
+            if storage.value is None:
+                qm.raiseRuntimeError(startpos, "variable %s is uninitialized and shouldn't be referenced" %  name)
+            return storage.value
+        return evalName
+        
+    elif expr.typeid == 'EXPFUNC':
+        nargs = len(expr.arrarg)
+        argfuncs = [lowerExpr(arg, scope = scope) for arg in expr.arrarg]
+        
+        if expr.name == '#QUALIFY':
+            idxpos = expr.arrarg[1].startpos
+            def evalQualify(qm):
+                args = [func(qm) for func in argfuncs]
+                ret = None
+                baseobj = args[0]
+                if baseobj.getType() != QBLObjectType.ObjType or baseobj.value != 'WORD':
+                    qm.raiseRuntimeError(startpos, "%s shouldn't be qualified with {}" % str(args[0]))
+                
+                idxarg = args[1]
+                argtype = idxarg.getType()
+                if argtype == QBLObjectType.Int:
+                    if idxarg.value>0:
+                        ret = QBLStructuredWordType(baseobj, idxarg.value)
+                elif argtype == QBLObjectType.List:
+                    bitsok = (len(idxarg.value)>0)
+                    bits = []
+                    for e in idxarg.value:
+                        if e == None:
+                            qm.raiseRuntimeError(idxpos, 'qualifer should be a fully initialized array')
+                        elif e not in [QBLObjectType.Bit, QBLObjectType.QBit]:
+                            bitsok = False
+                            break
+                        bits.append(e)     
+                    if bitsok:
+                        ret = QBLStructuredWordType(baseobj, bits)
+                if ret == None:    
+                    qm.raiseRuntimeError(idxpos, 'a positive integer or an array of bit types is expected as qualifier')
+                return ret
+            return evalQualify
+            
+        elif expr.name == '#ELEMENT':
+            idxpos = expr.arrarg[1].startpos
+            def evalElement(qm):
+                args = [func(qm) for func in argfuncs]
+                ret = None
+                arridx = None
+                isidxarr = False
+                baseobj = args[0]
+                if baseobj != QBLObjectType.QBit and not baseobj.getType().hasElements:
+                    qm.raiseRuntimeError(idxpos, "object of type %s doesn't provide elements" % str(baseobj.getType()))
+                if nargs == 2:
+                    idxarg = args[1]
+                    argtype = idxarg.getType()
+                    if argtype == QBLObjectType.Int or argtype == QBLObjectType.Str:
+                        arridx = idxarg.value
+                    elif argtype == QBLObjectType.List:
+                        isidxarr = True
+                        idxs = []
+                        for e in idxarg.value:
+                            if e == None:
+                                qm.raiseRuntimeError(idxpos, "index array shouldn't contain uninitialized element")
+                            elif e.objtype != QBLObjectType.Int:
+                                qm.raiseRuntimeError(idxpos, 'indices should be integers or array of integers')
+                            idxs.append(e.value)     
+                        arridx = idxs                        
+                else:
+                    qm.raiseRuntimeError(startpos, 'multiindices are not allowed') #shouldn't arrive here though
+                    
+                if arridx == None:
+                    qm.raiseRuntimeError(startpos, 'index value cannot be empty') 
+                if isidxarr:
+                    retval = []
+                    idxs = arridx
+                else:
+                    idxs = [arridx]
+                if isTarget:
+                    if baseobj.getType() != QBLObjectType.List:
+                        qm.raiseTargetError(startpos)
+                    return (baseobj, arridx)
+                for i in idxs:
+                    try:
+                        value = baseobj[i]
+                        idxok = True
+                    except IndexError:
+                        idxok = False
+                    except KeyError:
+                        idxok = False
+                    if not idxok:
+                        qm.raiseRuntimeError(idxpos, "there isn't any element for index %s" % str(i))
+                    if value is None:
+                        qm.raiseRuntimeError(startpos, "shouldn't refer to uninitialized element")
+                    if isidxarr:
+                        retval.append(value)
+                    else:
+                        ret = value
+                        
+                if isidxarr:
+                    ret = QBLListObject(value = retval)
+                return ret
+            return evalElement
+            
+        elif expr.name == '#ARRAY':
+            def evalArray(qm):
+                return QBLListObject([func(qm) for func in argfuncs])
+            return evalArray
+            
+        name = expr.name
+        idfunc = lowerExpr(expr.idexp, scope = scope) if expr.idexp != None else None
+        idpos = expr.idexp.startpos if expr.idexp != None else startpos
+        lookup = lowerLookup(name, scope) if idfunc == None else None
+        def evalCall(qm):
+            if idfunc != None:
+                idobj = idfunc(qm)
+            else:
+                idobj = lookup(qm, startpos).value
+            objtype = idobj.objtype
+            if objtype is QBLObjectType.FuncList:
+                try:
+                    idobj = idobj.value[nargs]
+                except KeyError:
+                    qm.raiseRuntimeError(idpos, 'function %s is not defined for %d arguments, only for %s' % (
+                        idobj.name,
+                        nargs,
+                        ', '.join([str(n) for n in idobj.value])
+                    ))
+            elif objtype is None:
+                if nargs != 1:
+                    qm.raiseRuntimeError(startpos, "casting to object type %s needs exactly one argument" % str(idobj))
+                arg = argfuncs[0](qm)
+                ret = qm.cast(idobj, arg)
+                if ret == None:
+                    qm.raiseRuntimeError(startpos, "object %s with type %s cannot be converted to type %s" % (str(arg), str(arg.getType()), str(idobj)))
+                return ret
+            elif objtype is not QBLObjectType.Function:
+                qm.raiseRuntimeError(idpos, "Object %s shouldn't be called as a function" % str(idobj))
+                
+            args = [func(qm) for func in argfuncs]
+            if nargs != idobj.nargs:
+                qm.raiseRuntimeError(startpos, "function '%s' requires %d arguments but found %d" % (idobj.name, idobj.nargs, nargs))
+            functype = idobj.functype
+            if functype == 'INTERNAL':
+                if not idobj.pure:
+                    qm.neffects += 1
+                try:
+                    ret = idobj.call(args)
+                except QBLRuntimeError as e:
+                    qm.raiseRuntimeError(startpos, e.desc)
+                if ret is NotImplemented:
+                    ret = callScript(qm, expr, idobj.fallback, args)
+                    
+            elif functype == 'SCRIPT':
+                ret = callScript(qm, expr, idobj, args)
+                
+            elif functype == 'TABLE':
+                ret = qm.callTable(startpos, idobj, args)
+            else: 
+                qm.raiseImplError(startpos)
+                
+            if not nullable and ret is None:
+                qm.raiseRuntimeError(startpos, "function %s expected to return a value, but it didn't" % idobj.name)
+            return ret
+        return evalCall
+                
+    elif expr.typeid == 'EXPDICT':
+        nbits = expr.nbits
+        dictfuncs = {i : lowerExpr(expr.dictexp[i], scope = scope) for i in expr.dictexp}
+        def evalDict(qm):
+            return QBLDictObject(nbits, {i : dictfuncs[i](qm) for i in dictfuncs})
+        return evalDict
+            
+    def evalImplError(qm):
+        qm.raiseImplError(startpos)
+    return evalImplError
+
+def lowerCommandNode(cmd, scope):
+    startpos = cmd.startpos
+    if cmd.typeid == 'IMPORT':
+        impname = cmd.impname
+        def execImport(qm):
+            qm.importSrc(impname, startpos)
+        return execImport
+        
+    elif cmd.typeid == 'CMDCALC':
+        local = cmd.local
+        arrassign = []
+        for i in range(len(cmd.tgtarr)):
+            tgtexp = cmd.tgtarr[i]
+            evalexp = cmd.evalarr[i]
+            evalfunc = lowerExpr(evalexp, nullable = (tgtexp == None), scope = scope) if evalexp != None else None
+            if tgtexp == None:
+                arrassign.append((evalfunc, None, None, None))
+            elif tgtexp.typeid == 'EXPNAME':
+                arrassign.append((evalfunc, lowerTarget(tgtexp.name, local, scope), None, tgtexp.startpos))
+            else:
+                arrassign.append((evalfunc, None, lowerExpr(tgtexp, isTarget = True, scope = scope), (tgtexp.startpos, evalexp.startpos if evalexp != None else None)))
+        def execCalc(qm):
+            for evalfunc, tgtsetup, tgtfunc, tgtpos in arrassign:
+                value = evalfunc(qm) if evalfunc != None else None
+                if tgtsetup != None:
+                    storage = tgtsetup(qm)
+                    if value is not None:                            
+                        qm.setValue(storage, value, tgtpos)
+                elif tgtfunc != None:
+                    tgtobj, tgtidx = tgtfunc(qm)
+                    if type(tgtidx) == list:
+                        valtyp = value.getType()
+                        if valtyp.value != 'LIST':
+                            qm.raiseRuntimeError(tgtpos[1], 'when assigning to multiple array elements, the value should be also an array')
+                        valarr = value.value
+                        lenidx = len(tgtidx)
+                        if lenidx != len(valarr):
+                            qm.raiseRuntimeError(startpos, 'target array indexes are not matching with source array length')
+                    else:
+                        valarr = [value]
+                        tgtidx = [tgtidx]
+                        lenidx = 1
+                    for i in range(lenidx):
+                        qm.setValue(tgtobj, valarr[i], tgtpos[0], tgtidx = tgtidx[i])
+        return execCalc
+                    
+    elif cmd.typeid == 'CMDFDEF':
+        if cmd.deftype == 'TABLE' and cmd.body == None:
+            def execTableFile(qm):
+                qm.addFunc(QBLFuncObject(cmd.name, cmd = qm.loadTableFile(cmd)))
+            return execTableFile
+        def execFuncDef(qm):
+            qm.addFunc(QBLFuncObject(cmd.name, cmd = cmd))
+        return execFuncDef
+    
+    elif cmd.typeid == 'CMDRET':
+        retfunc = lowerExpr(cmd.retexp, scope = scope) if cmd.retexp != None else None
+        def execReturn(qm):
+            return [retfunc(qm) if retfunc != None else None]
+        return execReturn
+        
+    elif cmd.typeid in ['CMDIF', 'CMDWHILE']:
+        condfunc = lowerExpr(cmd.condition, scope = scope)
+        condpos = cmd.condition.startpos
+        if cmd.typeid == 'CMDIF':
+            truefunc = lowerCommand(cmd.iftrue, scope) if cmd.iftrue != None else None
+            falsefunc = lowerCommand(cmd.iffalse, scope) if cmd.iffalse != None else None
+            def execIf(qm):
+                condvalue = condfunc(qm)
+                if condvalue.getType().value not in ['INT', 'BIT']:
+                    qm.raiseRuntimeError(condpos, 'condition should either int or bit type')
+                cmdfunc = truefunc if condvalue.value != 0 else falsefunc
+                if cmdfunc != None:
+                    return cmdfunc(qm)
+                return None
+            return execIf
+        else:
+            loopfunc = lowerCommand(cmd.command, scope) if cmd.command != None else None
+            def execWhile(qm):
+                while True:
+                    condvalue = condfunc(qm)
+                    if condvalue.getType().value not in ['INT', 'BIT']:
+                        qm.raiseRuntimeError(condpos, 'condition should either int or bit type')
+                    if condvalue.value == 0:
+                        break
+                    if loopfunc != None:
+                        retval = loopfunc(qm)
+                        if retval != None: return retval
+                return None
+            return execWhile
+                
+    elif cmd.typeid == 'CMDFOR':
+        listfunc = lowerExpr(cmd.listexp, scope = scope)
+        listpos = cmd.listexp.startpos
+        varsetup = lowerTarget(cmd.varname, True, scope)
+        loopfunc = lowerCommand(cmd.command, scope)
+        def execFor(qm):
+            listobj = listfunc(qm)
+            if listobj.getType() != QBLObjectType.List:
+                qm.raiseRuntimeError(listpos, 'can iterate a list only, instead found object with type '+str(listobj.getType()))
+            storage = varsetup(qm)
+            for iterobj in listobj.value:
+                storage.value = iterobj
+                retval = loopfunc(qm)
+                if retval != None: return retval
+            return None
+        return execFor
+            
+    elif cmd.typeid == 'CMDBLCK':
+        blockscope = Scope(cmd.arrcmd, parent = scope)
+        blockfuncs = [lowerCommand(bcmd, blockscope) for bcmd in cmd.arrcmd]
+        def execBlock(qm):
+            qm.addFrame(blockscope)
+            retval = None
+            for bfunc in blockfuncs:
+                retval = bfunc(qm)
+                if retval != None:
+                    break
+            qm.rmFrame()
+            return retval
+        return execBlock
+    
+    def execImplError(qm):
+        qm.raiseImplError(startpos)
+    return execImplError
@@ -5,39 +5,62 @@
 # Copyright (c) 2022-2023 Gergely Gálfi
 #
 
+import re
+import bisect
+
 from .error import *
 
 class SourcePosition:
-    def __init__(self, idx, linenum, linepos, srcfile = None, lexer = None):
-        self.srcfile = srcfile
-        self.idx=idx
-        self.linenum=linenum
-        self.linepos=linepos
+    __slots__ = ('idx', 'lexer')
+    
+    def __init__(self, idx, lexer):
+        self.idx = idx
         self.lexer = lexer
         
-    def copy(self):
-        return SourcePosition(self.idx, self.linenum, self.linepos, srcfile = self.srcfile, lexer = self.lexer)
-    
+    @property
+    def srcfile(self):
+        return self.lexer.srcfile
+        
+    @property
+    def linenum(self):
+        return self.lexer.getLineCol(self.idx)[0]
+        
+    @property
+    def linepos(self):
+        return self.lexer.getLineCol(self.idx)[1]
+        
     def __str__(self):
+        linenum, linepos = self.lexer.getLineCol(self.idx)
         return  '%sline:%d offset:%d' % (
             'filename: %s ' % self.srcfile if self.srcfile != None else '',
-            self.linenum,
-            self.linepos)
+            linenum,
+            linepos)
     
     def showSrc(self):
-        ret = self.lexer.getLine(self.linenum) + '\n'
-        ret += (' ' * (self.linepos-1)) + '^\n'
+        linenum, linepos = self.lexer.getLineCol(self.idx)
+        ret = self.lexer.getLine(linenum) + '\n'
+        ret += (' ' * (linepos-1)) + '^\n'
         return ret
         
 class Token:
-    def __init__(self, type, value, startpos, endpos = None, alnumname = False):
+    __slots__ = ('type', 'value', 'lexer', 'startidx', 'endidx', 'alnumname')
+    
+    def __init__(self, type, value, lexer, startidx, endidx = None, alnumname = False):
         self.type = type
         self.value = value
-        self.startpos = startpos
-        if endpos == None: self.endpos = startpos
-        else: self.endpos = endpos
+        self.lexer = lexer
+        self.startidx = startidx
+        self.endidx = endidx if endidx != None else startidx
         self.alnumname = alnumname
         
+    @property
+    def startpos(self):
+        return SourcePosition(self.startidx, self.lexer)
+        
+    @property
+    def endpos(self):
+        return SourcePosition(self.endidx, self.lexer)
+        
     def __str__(self):
         return "Token type:%s value:'%s'%s from %s to %s" % (
             self.type,
@@ -48,12 +71,27 @@ class Token:
     def __repr__(self):
         return self.__str__()
          
-def charType(c):
-    if c=='': return 'EOF'
-    if (c>='a' and c<='z') or (c>='A' and c<='Z'): return 'ALPHA'
-    elif c>='0' and c<='9': return 'NUM'
-    elif c in [' ', '\t', '\n', '\r']: return 'WS'
-    else: return 'OTHER'
+#Whitespace and the alternatives of the next token, tried in order
+tokenre = re.compile(r"""
+    [ \t\n\r]*(?:
+    (?P<OTHER>[(){}\[\],;:+\-*~%])
+    |(?P<NAME>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<NUM>[0-9.][A-Za-z0-9_.]*)
+    |(?P<OP>===|!==|==|!=|<=|>=|&&|\|\||>>|<<|[=!<>&|])
+    |(?P<STR>"[^"]*")
+    |(?P<QNAME>`[^`]*`)
+    |(?P<COMMENT>/\*(?:[^*]|\*[^/])*\*/|/%[^\n]*)
+    |(?P<SLASH>//?)
+    |(?P<CHAR>[^ \t\n\r]))
+    """, re.VERBOSE | re.DOTALL)
+
+alnumre = re.compile('[A-Za-z_][A-Za-z0-9_]*')
+
+#A dictionary of decimal integers, and its items
+intdictre = re.compile(r'[ \t\n\r]*\{([ \t\n\r]*[0-9]+[ \t\n\r]*:[ \t\n\r]*[0-9]+(?:[ \t\n\r]*,[ \t\n\r]*[0-9]+[ \t\n\r]*:[ \t\n\r]*[0-9]+)*)?[ \t\n\r]*\}')
+intre = re.compile('[0-9]+')
+
+quotedops = {'==', '!=', '===', '!==', '<', '>', '<=', '>=', '!', '&&', '||', '+', '-', '*', '/', '//', '~', '%'}
     
 class Lexer:
     def __init__(self, source = None, srcfile = None):
@@ -63,153 +101,71 @@ class Lexer:
         else:
             self.src=source
 
+        self.srcfile = srcfile
         self.len=len(self.src)
-        self.nextpos=SourcePosition(-1, 0, 0, srcfile = srcfile, lexer = self)
-        
-        self.state=0
-        self.str=''
-        self.holdchar=False
-        self.newline=True
+        self.pos = 0
         self.laarr=[None]
-        self.linearr = []
+        self.linearr = None
 
-    def prepNextToken(self):                
+    def prepNextToken(self):
+        src = self.src
         while True:
-            if not self.holdchar:
-                self.nextpos.idx+=1
-                if self.nextpos.idx<self.len:
-                    self.nextc=self.src[self.nextpos.idx]
-                    if self.newline:
-                        self.linearr.append(self.nextpos.idx)
-                        self.nextpos.linenum+=1
-                        self.nextpos.linepos=1
-                    else:
-                        self.nextpos.linepos+=1
-                    self.newline=(self.nextc=='\n')
+            m = tokenre.match(src, self.pos)
+            if m == None:
+                return None
+            kind = m.lastgroup
+            start = m.start(kind)
+            end = m.end()
+            self.pos = end
+            if kind == 'OTHER':
+                return Token('OTHER', m.group(kind), self, start)
+            elif kind == 'NAME':
+                return Token('NAME', m.group(kind), self, start, end - 1, True)
+            elif kind == 'OP':
+                op = m.group(kind)
+                if len(op) == 1 or op == '==' or op == '!=':
+                    return Token('OTHER', op, self, start)
+                return Token('OTHER', op, self, start, end - 1)
+            elif kind == 'NUM':
+                return Token('NUM', m.group(kind), self, start, end)
+            elif kind == 'STR':
+                return Token('STR', src[start + 1:end - 1], self, start, end - 1)
+            elif kind == 'QNAME':
+                name = src[start + 1:end - 1]
+                alnumname = alnumre.fullmatch(name) != None
+                if name != '' and (alnumname or name in quotedops):
+                    return Token('NAME', name, self, start, end - 1, alnumname = alnumname)
                 else:
-                    self.nextc=''
-            else:
-                self.holdchar=False
-            ctype=charType(self.nextc)
-
-            if self.state == 0:
-                if ctype == 'EOF':
-                    self.holdchar=True
-                    return None
-                elif ctype == 'ALPHA' or self.nextc == '_':
-                    self.state = 1
-                    self.startpos=self.nextpos.copy()
-                    self.endpos=self.nextpos.copy()
-                    self.str=self.nextc
-                elif ctype == 'NUM' or self.nextc == '.':
-                    self.state = 2
-                    self.startpos = self.nextpos.copy()
-                    self.endpos = self.nextpos.copy()
-                    self.str = self.nextc
-                elif ctype == 'WS':
-                    pass
-                elif self.nextc in ['=', '!', '<', '>', '&', '|']:
-                    self.state = 3
-                    self.str = self.nextc
-                    self.startpos = self.nextpos.copy()
-                elif self.nextc == '"':
-                    self.state = 5
-                    self.startpos = self.nextpos.copy()
-                    self.str = ''
-                elif self.nextc == '`':
-                    self.state = 7
-                    self.startpos = self.nextpos.copy()
-                    self.str = ''
-                    self.alnumname = True
-                elif self.nextc == '/':
-                    self.state = 9
-                    self.startpos=self.nextpos.copy()
-                else:
-                    return Token('OTHER', self.nextc, self.nextpos.copy())
-                    
-            elif self.state == 1:
-                if(ctype=='ALPHA' or ctype == 'NUM'  or self.nextc == '_'):
-                    self.str+=self.nextc
-                    self.endpos=self.nextpos.copy()
-                else:
-                    self.holdchar=True
-                    self.state = 0
-                    return Token('NAME', self.str, self.startpos, self.endpos, True)
-                
-            elif self.state == 2:
-                if ctype == 'NUM' or ctype == 'ALPHA' or self.nextc in ['_', '.']:
-                    self.str+=self.nextc
-                    self.endpos=self.nextpos.copy()
-                else:
-                    self.holdchar=True
-                    self.state = 0
-                    return Token('NUM', self.str, self.startpos, self.nextpos.copy())
-            
-            elif self.state == 3:
-                opstr = self.str+self.nextc
-                if opstr in ['===', '!==', '<=', '>=', '&&', '||', '>>', '<<']:
-                    self.state = 0
-                    return Token('OTHER', opstr, self.startpos, self.nextpos.copy())
-                elif opstr in ['==', '!=']:
-                    self.str = opstr
-                else:
-                    self.state = 0
-                    self.holdchar=True
-                    return Token('OTHER', self.str, self.startpos)
-                        
-            elif self.state == 5:
-                if self.nextc == '"':
-                    self.state = 0
-                    return Token('STR', self.str, self.startpos, self.nextpos.copy())
-                elif self.nextc =='':
-                    raise QBLSyntaxError(self.startpos, "Untermintated string")
-                else:
-                    self.str += self.nextc
-                    
-            elif self.state == 7:
-                if self.nextc == '`':
-                    self.state = 0
-                    if self.str != '' and (self.alnumname or self.str in ['==', '!=', '===', '!==', '<', '>', '<=', '>=', '!', '&&', '||', '+', '-', '*', '/', '//', '~', '%']):
-                        return Token('NAME', self.str, self.startpos, endpos = self.nextpos.copy(), alnumname = self.alnumname)
-                    else:
-                        raise QBLSyntaxError(self.startpos, "Illegal quoted name: "+self.str)
-                else:
-                    if ctype!='ALPHA' and self.nextc != '_' and (self.str == '' or ctype != 'NUM'):
-                        self.alnumname = False
-                    self.str += self.nextc
-                    
-            elif self.state == 9:
-                if self.nextc == '*':                    
-                    self.state = 10
-                elif self.nextc == '%':
-                    self.state = 11
-                elif self.nextc == '/':
-                    self.state = 0
-                    return Token('OTHER', '//', self.startpos)
-                else:
-                    self.holdchar=True
-                    self.state = 0
-                    return Token('OTHER', '/', self.startpos)
-                
-            elif self.state == 10:
-                if self.nextc == '*':                    
-                    self.state = 12
-                elif self.nextc == '':
-                    raise QBLSyntaxError(self.startpos, "Unterminated comment")
-                    
-            elif self.state == 11:
-                if self.nextc in ['\n', '']:
-                    self.state = 0
-                
-            elif self.state == 12:
-                if self.nextc == '/':
-                    self.state = 0
-                elif self.nextc == '':
-                    raise QBLSyntaxError(self.startpos, "Unterminated comment")
-                else:
-                    self.state = 10
-
+                    raise QBLSyntaxError(SourcePosition(start, self), "Illegal quoted name: "+name)
+            elif kind == 'SLASH':
+                if end - start == 1 and end < self.len and src[end] == '*':
+                    raise QBLSyntaxError(SourcePosition(start, self), "Unterminated comment")
+                return Token('OTHER', m.group(kind), self, start)
+            elif kind == 'CHAR':
+                c = m.group(kind)
+                if c == '"':
+                    raise QBLSyntaxError(SourcePosition(start, self), "Untermintated string")
+                elif c == '`':
+                    raise QBLSyntaxError(SourcePosition(start, self), "Unterminated quoted name")
+                return Token('OTHER', c, self, start)
 
+    def scanIntDict(self):
+        # Reads a { key : value, ... } dictionary of distinct decimal integers directly from the source, returning
+        # it with its closing brace token. Returns None and consumes nothing if the source has any other form there.
+        if len(self.laarr) > 1:
+            return None
+        m = intdictre.match(self.src, self.pos)
+        if m == None:
+            return None
+        nums = [int(s) for s in intre.findall(self.src, m.start(1), m.end(1))] if m.start(1) >= 0 else []
+        ret = dict(zip(nums[0::2], nums[1::2]))
+        if 2 * len(ret) != len(nums):
+            return None
+        self.pos = m.end()
+        closepar = Token('OTHER', '}', self, self.pos - 1)
+        self.laarr = [closepar]
+        return ret, closepar
+        
     def lookAheadToken(self, n):
         while len(self.laarr)<=n+1:
             tok=self.prepNextToken()
@@ -219,15 +175,32 @@ class Lexer:
         return self.laarr[n+1]
     
     def nextToken(self):
-        ret=self.lookAheadToken(0)
-        if ret!=None: del self.laarr[0]
-        return ret
+        laarr = self.laarr
+        if len(laarr) < 2:
+            tok = self.prepNextToken()
+            if tok == None:
+                return None
+            laarr.append(tok)
+        del laarr[0]
+        return laarr[0]
     
+    def __getstate__(self):
+        #a pickled lexer only needs to locate positions
+        return {'src': self.src, 'srcfile': self.srcfile, 'len': self.len, 'linearr': self.linearr}
+        
+    def getLineCol(self, idx):
+        # Line number and position within the line of the character at idx, both starting from 1.
+        # A position past the end is reported at the last character.
+        if self.linearr == None:
+            self.linearr = [0] + [m.end() for m in re.finditer('\n', self.src) if m.end() < self.len]
+        if self.len == 0:
+            return 0, 0
+        idx = min(idx, self.len - 1)
+        linenum = bisect.bisect_right(self.linearr, idx)
+        return linenum, idx - self.linearr[linenum - 1] + 1
+        
     def getLine(self, linenum):
         start = self.linearr[linenum - 1]
-        end = start
-        n = len(self.src)
-        while end < n and self.src[end] != '\n':
-            end += 1
-        return self.src[start:end]
+        end = self.src.find('\n', start)
+        return self.src[start:end] if end >= 0 else self.src[start:]
         
@@ -28,10 +28,23 @@ def raiseUnexpTokenError(lexer):
         raise UnexpEndError(lexer)
         
 class TreeNode:
+    __slots__ = ('typeid', 'startpos', 'endpos', 'lowered')
+    
     def __init__(self, typeid, startpos, endpos):
         self.typeid = typeid
         self.startpos = startpos
         self.endpos = endpos
+        self.lowered = {} #closures the compiler lowered this node into
+        
+    def __getstate__(self):
+        #the lowered closures are not pickled, they are rebuilt when the node is compiled again
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state['lowered'] = {}
+        return None, state
         
     def __str__(self):
         return 'Node type:%s from %s to %s' % (self.typeid, str(self.startpos), str(self.endpos))
@@ -44,6 +57,8 @@ class TreeNode:
         
 
 class ExprConst(TreeNode):
+    __slots__ = ('obj',)
+    
     def __init__(self, startpos, endpos, obj):
         super().__init__('EXPCONS', startpos, endpos)
         self.obj=obj
@@ -52,6 +67,8 @@ class ExprConst(TreeNode):
         return super().__str__()+ ' value: ' + repr(self.obj)
                                   
 class ExprName(TreeNode):
+    __slots__ = ('name',)
+    
     def __init__(self, nametok):
         super().__init__('EXPNAME', nametok.startpos, nametok.endpos)
         self.name=nametok.value
@@ -60,6 +77,8 @@ class ExprName(TreeNode):
         return super().__str__()+(' name:%s' % (self.name,))
         
 class ExprFunc(TreeNode):
+    __slots__ = ('idexp', 'name', 'arrarg')
+    
     def __init__(self, startpos,  endpos, funcid, arrarg):
         super().__init__('EXPFUNC', startpos, endpos)
         if type(funcid) == str:
@@ -83,6 +102,8 @@ class ExprFunc(TreeNode):
             self.arrarg[i].print(indent+'|')
 
 class ExprDict(TreeNode):
+    __slots__ = ('dictexp', 'nbits')
+    
     def __init__(self, startpos,  endpos, dictexp, nbits):
         super().__init__('EXPDICT', startpos, endpos)
         self.dictexp = dictexp
@@ -102,6 +123,8 @@ def int2word(x, nbits):
     return [(x>>i) &1 for i in range(nbits)]
 
 class CmdImport(TreeNode):
+    __slots__ = ('impname',)
+    
     def __init__(self, startpos, endpos, impname):        
         super().__init__('IMPORT', startpos, endpos)
         self.impname = impname
@@ -115,15 +138,18 @@ class CmdImport(TreeNode):
             
 
 class CmdFuncDef(TreeNode):
-    def __init__(self, startpos, endpos, deftype, nametok, args, body):        
+    __slots__ = ('deftype', 'nametok', 'name', 'body', 'tblfile', 'args', 'nargs')
+    
+    def __init__(self, startpos, endpos, deftype, nametok, args, body, tblfile = None):        
         super().__init__('CMDFDEF', startpos, endpos)
         self.deftype = deftype
         self.nametok = nametok
         self.name = nametok.value
         self.body = body
+        self.tblfile = tblfile #table read from this file when defining the function, body is None until then
         if self.deftype == 'TABLE':
             self.args = None
-            self.nargs = body[0]
+            self.nargs = body[0] if body != None else None
         elif self.deftype == 'SCRIPT':
             self.args = args
             self.nargs = len(args)
@@ -133,7 +159,9 @@ class CmdFuncDef(TreeNode):
     
     def print(self, indent=''):
         super().print(indent)
-        if self.deftype == 'TABLE':
+        if self.deftype == 'TABLE' and self.body == None:
+            print(indent+'|Table file: ' + self.tblfile)
+        elif self.deftype == 'TABLE':
             print(indent+'|Table items:')
             tbl = self.body[2]
             nin = self.body[0]
@@ -145,6 +173,8 @@ class CmdFuncDef(TreeNode):
                 cmd.print(indent+'|')
         
 class CmdCalc(TreeNode):
+    __slots__ = ('tgtarr', 'evalarr', 'local')
+    
     def __init__(self, startpos, endpos, tgtarr, evalarr, local):
         super().__init__('CMDCALC', startpos, endpos)
         self.tgtarr = tgtarr
@@ -167,6 +197,8 @@ class CmdCalc(TreeNode):
                 evalexp.print(indent+'|') 
 
 class CmdIf(TreeNode):
+    __slots__ = ('condition', 'iftrue', 'iffalse')
+    
     def __init__(self, startpos, endpos, condition, iftrue, iffalse):
         super().__init__('CMDIF', startpos, endpos)
         self.condition = condition
@@ -185,6 +217,8 @@ class CmdIf(TreeNode):
             self.iffalse.print(indent+'|')
 
 class CmdWhile(TreeNode):
+    __slots__ = ('condition', 'command')
+    
     def __init__(self, startpos, endpos, condition, command):
         super().__init__('CMDWHILE', startpos, endpos)
         self.condition = condition
@@ -199,6 +233,8 @@ class CmdWhile(TreeNode):
             self.command.print(indent+'|')
 
 class CmdFor(TreeNode):
+    __slots__ = ('nametok', 'varname', 'listexp', 'command')
+    
     def __init__(self, startpos, endpos, nametok, listexp, command):
         super().__init__('CMDFOR', startpos, endpos)
         self.nametok = nametok
@@ -218,6 +254,8 @@ class CmdFor(TreeNode):
             self.command.print(indent+'|')
             
 class CmdReturn(TreeNode):
+    __slots__ = ('retexp',)
+    
     def __init__(self, startpos, endpos, retexp):
         super().__init__('CMDRET', startpos, endpos)
         self.retexp = retexp
@@ -229,6 +267,8 @@ class CmdReturn(TreeNode):
             self.retexp.print(indent+'|')
 
 class CmdBlock(TreeNode):
+    __slots__ = ('arrcmd',)
+    
     def __init__(self, startpos, endpos, arrcmd):
         super().__init__('CMDBLCK', startpos, endpos)
         self.arrcmd=arrcmd
@@ -395,6 +435,13 @@ def processDictItems(lexer, itemset, ninbits, forcebits):
     return (isint, maxnbits if nbits == None else nbits, retdict)
 
             
+def tableBody(tbl):
+    # Body of a table function from a dict of non-negative integer inputs and outputs, missing inputs give 0
+    ninbits = max(tbl).bit_length() if len(tbl) > 0 else 0
+    tbldict = {i : tbl.get(i, 0) for i in range(1<<ninbits)}
+    noutbits = max(tbldict.values()).bit_length()
+    return (ninbits, noutbits, tbldict)
+    
 def parseCommaList(lexer, closepar, isdict = False):
     clarr = []
     firstitem = True
@@ -559,6 +606,16 @@ def parseCommand(lexer, returnOnSemicolon = False, depth = 0, inFunc = False):
                         UnexpEndError(lexer)
                     elif tok.type == 'NAME' and tok.value == 'table':
                         lexer.nextToken()
+                        scanned = lexer.scanIntDict()
+                        if scanned != None:
+                            #large tables are usually plain integers, read without building expressions
+                            tbl, closepar = scanned
+                            return CmdFuncDef(startpos, closepar.endpos, "TABLE", nametok, None, tableBody(tbl))
+                        tok = lexer.lookAheadToken(0)
+                        if tok != None and tok.type == 'STR':
+                            lexer.nextToken()
+                            closesc = nextTokenAssert(lexer, ';')
+                            return CmdFuncDef(startpos, closesc.endpos, "TABLE", nametok, None, None, tblfile = tok.value)
                         isint, ninbits, parsedict = parseDictionary(lexer, True)
                         isint, noutbits, tbldict = processDictItems(lexer, parsedict, ninbits, True)
                         return CmdFuncDef(startpos, lexer.nextToken().endpos, "TABLE", nametok, None, (ninbits, noutbits, tbldict))
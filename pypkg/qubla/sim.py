@@ -5,19 +5,164 @@
 # Copyright (c) 2022-2023 Gergely Gálfi
 #
 
+import os
+import time
+import json
+import hashlib
+import tempfile
+import tracemalloc
+import weakref
+import multiprocessing
+import multiprocessing.util
+from multiprocessing import shared_memory
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from .parser import int2word
+from .error import QBLError
+
+def requireNumpy(feature):
+    if np == None:
+        raise QBLError("%s requires numpy, which couldn't be imported" % feature)
+
+class StepProfiler:
+    # Collects a record for every step (or group of steps applied together) of a simulator run:
+    # the indices of the steps in qm.arrstep as printed by str(QuantumLogic), the step type,
+    # the number of qubits touched, the wall time, the peak bytes allocated during the step
+    # (traced by tracemalloc if trackmem is set) and the engine path taken.
+    # callback is called with each record when it is complete.
+    def __init__(self, trackmem = True, callback = None):
+        self.trackmem = trackmem
+        self.callback = callback
+        self.records = []
+        self.ownstrace = False
+
+    def begin(self):
+        if self.trackmem and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.ownstrace = True
+
+    def end(self):
+        if self.ownstrace:
+            tracemalloc.stop()
+            self.ownstrace = False
+
+    def startStep(self):
+        if self.trackmem:
+            tracemalloc.reset_peak()
+            self.startmem = tracemalloc.get_traced_memory()[0]
+        self.starttime = time.perf_counter()
+
+    def endStep(self, arrstepidx, sttype, nstqb, path):
+        elapsed = time.perf_counter() - self.starttime
+        nbytes = tracemalloc.get_traced_memory()[1] - self.startmem if self.trackmem else None
+        rec = {'steps': list(arrstepidx), 'type': sttype, 'qubits': nstqb, 'time': elapsed, 'bytes': nbytes, 'path': path}
+        self.records.append(rec)
+        if self.callback != None:
+            self.callback(rec)
+
+    def report(self, sortby = 'time', top = None):
+        if sortby == 'steps':
+            arrrec = self.records
+        else:
+            arrrec = sorted(self.records, key = lambda rec: rec[sortby] if rec[sortby] != None else 0, reverse = True)
+        if top != None:
+            arrrec = arrrec[:top]
+        total = sum([rec['time'] for rec in self.records])
+        ret = '%-16s %-8s %6s %12s %6s %14s  %s\n' % ('steps', 'type', 'qubits', 'time [ms]', '%', 'bytes', 'path')
+        for rec in arrrec:
+            steps = ','.join([str(i) for i in rec['steps']])
+            if len(steps) > 16:
+                steps = '%d-%d (%d)' % (rec['steps'][0], rec['steps'][-1], len(rec['steps']))
+            ret += '%-16s %-8s %6d %12.3f %6.1f %14s  %s\n' % (
+                steps, rec['type'], rec['qubits'], rec['time'] * 1000, 100 * rec['time'] / total if total > 0 else 0,
+                str(rec['bytes']) if rec['bytes'] != None else '-', rec['path'])
+        ret += 'total time: %.3f ms in %d records\n' % (total * 1000, len(self.records))
+        return ret
+
+    def dump(self, filename = None):
+        if filename == None:
+            return json.dumps(self.records, indent = 1)
+        with open(filename, 'w', encoding = 'utf-8') as f:
+            json.dump(self.records, f, indent = 1)
+
+def profStart(profiler):
+    if profiler != None:
+        profiler.startStep()
+
+def profEnd(profiler, arrstepidx, sttype, nstqb, path):
+    if profiler != None:
+        profiler.endStep(arrstepidx, sttype, nstqb, path)
+
+# Evaluated initial states and operator matrices keyed by the structure of their values,
+# so identical operators built by separate calls are evaluated only once
+evalcache = {}
+maxevalcache = 4096
+
+def rationalKey(r):
+    return (r.numtype, tuple(r.value) if r.numtype != 'INT' else r.value)
+
+def cplxKey(values):
+    # The text of a value isn't unique (unary minus is printed without parentheses), so the key follows its tree
+    if type(values) == list:
+        return tuple([cplxKey(v) for v in values])
+    if values.isfunc:
+        return (values.funcname, tuple([cplxKey(a) for a in values.arrarg]))
+    return (rationalKey(values.real), rationalKey(values.imag))
+
+def evalNested(values):
+    if type(values) == list:
+        return tuple([evalNested(v) for v in values])
+    return complex(values.evaluate())
+
+def evalCplxArray(values):
+    # Read-only numpy array (nested tuples without numpy) of a list or matrix of ComplexValues
+    key = cplxKey(values)
+    ret = evalcache.get(key)
+    if ret is None:
+        ret = evalNested(values)
+        if np != None:
+            ret = np.array(ret, dtype = complex)
+            ret.flags.writeable = False
+        if len(evalcache) >= maxevalcache:
+            evalcache.clear()
+        evalcache[key] = ret
+    return ret
+
+def isUnitary(matr, tol = 0.0001):
+    nbase = len(matr)
+    rbase = range(nbase)
+    if np != None:
+        diff = matr @ matr.conj().T - np.eye(nbase)
+        return bool((np.abs(diff)**2 <= tol).all())
+    for i in rbase:
+        for k in rbase:
+            testval = sum([matr[i][s] * (matr[k][s].conjugate()) for s in rbase])
+            if i == k:
+                testval -= 1.0 + 0j
+            if (testval * (testval.conjugate())).real > tol:
+                return False
+    return True
 
-def statevec(qm):
+def prepInitSteps(qm):
     inited = [False for i in range(qm.nqb)]
     arrinitstep = []
     for i in range(qm.nqb):
         if not inited[i]:
-            initst = qm.arrstep[qm.arrqbcompr[i].arrstep[0]]
+            initidx = qm.arrqbcompr[i].arrstep[0]
+            initst = qm.arrstep[initidx]
             if initst.typeid == 'INIT':
                 arrinitqb = initst.arrqb.copy()
-                arrstate = [initst.state[k].evaluate() for k in range(initst.nbase)]
+                arrstate = initst.getEvalState()
             elif initst.typeid == 'APPTBL':
-                arrinitqb = [qb for qb in initst.arrqbout if not qb in initst.arrqbin]
+                # Output only qubits start from 0 if this table is their first step, the table
+                # can be reached again from its other input qubits but each qubit must belong
+                # to a single group
+                arrinitqb = [qb for qb in initst.arrqbout if not qb in initst.arrqbin
+                    and qm.arrqb[qb].arrstep[0] == initidx and not inited[qm.arrqb[qb].compridx]]
                 arrstate = [1.0+0j if k == 0 else 0j for k in range(1<<len(arrinitqb))]
             else:
                 arrinitqb = []
@@ -28,19 +173,13 @@ def statevec(qm):
                     arrinitqb[k] = qb
                     inited[qb] = True
                 arrinitstep.append((arrinitqb, arrstate))
-       
-    nbas = 1<<qm.nqb
-    state = []
-    for i in range(nbas):
-        comp = 1.0+0j
-        bits = int2word(i, qm.nqb)
-        for arrinitqb, arrstate in arrinitstep:
-            key = 0
-            for k in range(len(arrinitqb)):
-                key |= (bits[arrinitqb[k]])<<k
-            comp = comp*arrstate[key]
-        state.append(comp)
+    return arrinitstep
+
+def prepStepIdx(qm, arrtype = ['APPTBL', 'APPOP']):
+    # Indices in qm.arrstep of the steps returned by prepSteps (or of the INIT steps)
+    return [i for i in range(len(qm.arrstep)) if qm.arrstep[i] != None and qm.arrstep[i].typeid in arrtype]
 
+def prepSteps(qm):
     arrprepst = []
     for step in qm.arrstep:
         if step != None and step.typeid in ['APPTBL', 'APPOP']:
@@ -59,8 +198,8 @@ def statevec(qm):
                     inidx = 0
                     outidx = 0
                     for k in range(step.nin):
-                        inbit = ((i >> arrinidx[k]) & 1)
-                        inidx |= inbit << k
+                        inbit = ((i >> k) & 1)
+                        inidx |= inbit << arrinidx[k]
                         if step.arrcopy[k]:
                             outidx |= inbit << arrinidx[k]
                     outval = step.tbl[i]
@@ -68,10 +207,28 @@ def statevec(qm):
                         outidx |= ((outval >> k) & 1) << arroutidx[k]
                     invtbl[outidx] = inidx
             elif step.typeid == 'APPOP':
-                invtbl = [[step.opmatr[i][k].evaluate() for k in rstqb] for i in rstqb]
-            
+                invtbl = step.getEvalMatr()
+
             arrprepst.append((step.typeid, stqb, mask, invtbl))
-            
+    return arrprepst
+
+def statevecPy(qm):
+    arrinitstep = prepInitSteps(qm)
+
+    nbas = 1<<qm.nqb
+    state = []
+    for i in range(nbas):
+        comp = 1.0+0j
+        bits = int2word(i, qm.nqb)
+        for arrinitqb, arrstate in arrinitstep:
+            key = 0
+            for k in range(len(arrinitqb)):
+                key |= (bits[arrinitqb[k]])<<k
+            comp = comp*arrstate[key]
+        state.append(comp)
+
+    arrprepst = prepSteps(qm)
+
     for sttype, stqb, mask, invtbl in arrprepst:
         #print('invtbl',invtbl)
         newstate = []
@@ -85,7 +242,7 @@ def statevec(qm):
                 newcomp = 0.0j
                 for inb in range(1<<nstqb):
                     stidx = mask & i
-                    for k in rstqb:                        
+                    for k in rstqb:
                         stidx |= ((inb>>k)&1)<<stqb[k]
                     #print('i:', i, ' inb:', inb, ' outb:', outb, ' stidx:', stidx, ' invtbl:',invtbl)
                     newcomp += invtbl[outb][inb]*state[stidx]
@@ -95,15 +252,802 @@ def statevec(qm):
                 if inb == None:
                     newstate.append(0j)
                 else:
-                    stidx = mask & i 
-                    for k in rstqb: 
+                    stidx = mask & i
+                    for k in rstqb:
                         stidx |= ((inb>>k)&1)<<stqb[k]
                     newstate.append(state[stidx])
         state = newstate
         #print('State:', state)
     return state
 
+def stepAxes(nqb, stqb):
+    # Axes of the state tensor (reshaped to [2]*nqb) belonging to the step's qubits,
+    # ordered so that the flattened local index equals the step's local basis index
+    return [nqb - 1 - stqb[k] for k in range(len(stqb) - 1, -1, -1)]
+
+def prepStepsNp(qm):
+    arrprepst = []
+    for sttype, stqb, mask, invtbl in prepSteps(qm):
+        if sttype == 'APPOP':
+            op = np.array(invtbl, dtype = complex)
+        else:
+            op = np.array([inb if inb != None else 0 for inb in invtbl], dtype = np.intp)
+            iszero = np.array([inb == None for inb in invtbl], dtype = bool)
+            op = (op, iszero if iszero.any() else None)
+        arrprepst.append((sttype, stqb, op))
+    return arrprepst
+
+def initStateNp(nqb, arrinitstep, chunkqb = None, chidx = 0):
+    # Kronecker product of the INIT groups' amplitude vectors, transposed once into qubit order.
+    # With chunkqb only the chunk chidx is built: qubits from chunkqb up are fixed to the bits
+    # of chidx and select one slice of each group's vector.
+    nloc = nqb if chunkqb == None else chunkqb
+    tens = np.ones((), dtype = complex)
+    arraxqb = []
+    for arrinitqb, arrstate in arrinitstep:
+        revqb = arrinitqb[::-1]
+        grp = np.asarray(arrstate, dtype = complex).reshape([2]*len(revqb))
+        grp = grp[tuple([slice(None) if qb < nloc else (chidx >> (qb - nloc)) & 1 for qb in revqb])]
+        tens = np.multiply.outer(tens, grp)
+        arraxqb.extend([qb for qb in revqb if qb < nloc])
+    # Qubits without initialization have unit amplitudes
+    for qb in range(nloc):
+        if qb not in arraxqb:
+            tens = np.multiply.outer(tens, np.ones(2, dtype = complex))
+            arraxqb.append(qb)
+    return np.transpose(tens, [arraxqb.index(nloc - 1 - ax) for ax in range(nloc)]).reshape(-1)
+
+def applyStepNp(state, nqb, sttype, stqb, op):
+    nstqb = len(stqb)
+    axes = stepAxes(nqb, stqb)
+    front = list(range(nstqb))
+    tens = np.moveaxis(state.reshape([2]*nqb), axes, front).reshape(1<<nstqb, -1)
+    if sttype == 'APPOP':
+        if isDiagOp(op):
+            tens = tens * np.diagonal(op)[:, None]
+        else:
+            tens = np.tensordot(op, tens, axes = 1)
+    else:
+        invidx, iszero = op
+        tens = tens[invidx]
+        if iszero is not None:
+            tens[iszero] = 0
+    return np.moveaxis(tens.reshape([2]*nqb), front, axes).reshape(-1)
+
+def isDiagOp(op):
+    return not (op - np.diag(np.diagonal(op))).any()
+
+def stepPathNp(sttype, op):
+    if sttype == 'APPTBL':
+        return 'gather'
+    return 'diagonal' if isDiagOp(op) else 'dense matmul'
+
+def composeTblRun(run):
+    # Consecutive table steps only permute the basis states, they are composed into one
+    # table step over the union of their qubits by tracing each output index back
+    # through the run, from the last step to the first
+    runqb = []
+    for stqb, op in run:
+        runqb.extend([qb for qb in stqb if qb not in runqb])
+    idx = np.arange(1<<len(runqb), dtype = np.int64)
+    zero = None
+    for stqb, (invidx, iszero) in reversed(run):
+        locpos = [runqb.index(qb) for qb in stqb]
+        locidx = gatherBitsNp(idx, locpos)
+        if iszero is not None:
+            zero = iszero[locidx] if zero is None else zero | iszero[locidx]
+        mask = 0
+        for pos in locpos:
+            mask |= 1<<pos
+        idx = (idx & ~mask) | scatterBitsNp(len(locpos), locpos)[invidx[locidx]]
+    return (runqb, (idx.astype(np.intp), zero if zero is not None and zero.any() else None))
+
+def applyTblRunNp(state, nqb, run):
+    if len(run) == 0:
+        return state
+    stqb, op = run[0] if len(run) == 1 else composeTblRun(run)
+    return applyStepNp(state, nqb, 'APPTBL', stqb, op)
+
+# States saved by statevecNp at step intervals, keyed by the hash of the initial state
+# and the steps leading to them, shared between QuantumLogic objects
+checkpoints = {}
+maxcheckpointbytes = 1<<30
+
+def prefixHashes(nqb, arrinitstep, arrprepst):
+    # Element k is the hash of the initial state and the first k steps
+    hsh = hashlib.sha1(repr(nqb).encode())
+    for arrinitqb, arrstate in arrinitstep:
+        hsh.update(repr(arrinitqb).encode())
+        hsh.update(np.asarray(arrstate, dtype = complex).tobytes())
+    ret = [hsh.digest()]
+    for sttype, stqb, op in arrprepst:
+        hsh.update(repr((sttype, stqb)).encode())
+        if sttype == 'APPOP':
+            hsh.update(op.tobytes())
+        else:
+            hsh.update(op[0].tobytes())
+            hsh.update(b'' if op[1] is None else op[1].tobytes())
+        ret.append(hsh.digest())
+    return ret
+
+def storeCheckpoint(key, state):
+    checkpoints[key] = state.copy()
+    total = sum([chk.nbytes for chk in checkpoints.values()])
+    while total > maxcheckpointbytes:
+        oldest = next(iter(checkpoints))
+        total -= checkpoints.pop(oldest).nbytes
+
+def flushTblRun(state, nqb, run, runidx, profiler):
+    if len(run) == 0:
+        return state
+    profStart(profiler)
+    state = applyTblRunNp(state, nqb, run)
+    nrunqb = len(set().union(*[stqb for stqb, op in run]))
+    profEnd(profiler, runidx, 'APPTBL', nrunqb, 'gather' if len(run) == 1 else 'composed gather')
+    return state
+
+def statevecNp(qm, maxrunqb = 16, chkinterval = 0, profiler = None):
+    requireNumpy("simulator engine 'numpy'")
+    # A profiled run always simulates
+    if qm.simstate is not None and profiler == None:
+        return qm.simstate.copy()
+    if profiler != None:
+        profiler.begin()
+    profStart(profiler)
+    arrinitstep = prepInitSteps(qm)
+    arrprepst = prepStepsNp(qm)
+    arrstepidx = prepStepIdx(qm)
+    nsteps = len(arrprepst)
+    start = 0
+    if chkinterval > 0:
+        hashes = prefixHashes(qm.nqb, arrinitstep, arrprepst)
+        for pos in range(nsteps, 0, -1):
+            if hashes[pos] in checkpoints:
+                start = pos
+                break
+    if start > 0:
+        state = checkpoints[hashes[start]].copy()
+        profEnd(profiler, arrstepidx[:start], 'INIT', qm.nqb, 'checkpoint')
+    else:
+        state = initStateNp(qm.nqb, arrinitstep)
+        profEnd(profiler, prepStepIdx(qm, ['INIT']), 'INIT', qm.nqb, 'kronecker init')
+    run = []
+    runidx = []
+    runqb = set()
+    for stepidx in range(start, nsteps):
+        sttype, stqb, op = arrprepst[stepidx]
+        if sttype == 'APPTBL':
+            if len(runqb.union(stqb)) > maxrunqb:
+                state = flushTblRun(state, qm.nqb, run, runidx, profiler)
+                run = []
+                runidx = []
+                runqb = set()
+            run.append((stqb, op))
+            runidx.append(arrstepidx[stepidx])
+            runqb.update(stqb)
+        else:
+            state = flushTblRun(state, qm.nqb, run, runidx, profiler)
+            run = []
+            runidx = []
+            runqb = set()
+            profStart(profiler)
+            state = applyStepNp(state, qm.nqb, sttype, stqb, op)
+            profEnd(profiler, [arrstepidx[stepidx]], sttype, len(stqb), stepPathNp(sttype, op))
+        pos = stepidx + 1
+        if chkinterval > 0 and (pos % chkinterval == 0 or pos == nsteps) and hashes[pos] not in checkpoints:
+            state = flushTblRun(state, qm.nqb, run, runidx, profiler)
+            run = []
+            runidx = []
+            runqb = set()
+            storeCheckpoint(hashes[pos], state)
+    state = flushTblRun(state, qm.nqb, run, runidx, profiler)
+    if profiler != None:
+        profiler.end()
+    # Kept until the steps of qm change
+    qm.simstate = state.copy()
+    return state
+
+class SparseState:
+    def __init__(self, nqb, idx, amp):
+        self.nqb = nqb
+        self.idx = idx
+        self.amp = amp
+
+    def __len__(self):
+        return 1<<self.nqb
+
+    def __getitem__(self, i):
+        pos = np.searchsorted(self.idx, i)
+        if pos < len(self.idx) and self.idx[pos] == i:
+            return self.amp[pos]
+        return 0j
+
+    def todense(self):
+        ret = np.zeros(1<<self.nqb, dtype = complex)
+        ret[self.idx] = self.amp
+        return ret
+
+    def getDens(self, arrqb):
+        return reduceProbs(self, arrqb)
+
+    def __str__(self):
+        return 'SparseState(nqb = %d, nnz = %d)' % (self.nqb, len(self.idx))
+
+def idxDtype(nqb):
+    # Basis indices of wide logics don't fit into int64, those are stored as Python ints
+    return np.int64 if nqb < 63 else object
+
+def gatherBitsNp(idx, arrqb):
+    ret = np.zeros(len(idx), dtype = np.int64)
+    for k in range(len(arrqb)):
+        ret |= ((idx >> arrqb[k]) & 1).astype(np.int64) << k
+    return ret
+
+def scatterBitsNp(nbits, arrqb, dtype = np.int64):
+    loc = np.arange(1<<nbits, dtype = np.int64)
+    ret = np.zeros(1<<nbits, dtype = dtype)
+    for k in range(nbits):
+        ret |= ((loc >> k) & 1).astype(dtype) << arrqb[k]
+    return ret
+
+def sortSparse(idx, amp, tol):
+    keep = np.abs(amp) > tol
+    idx = idx[keep]
+    amp = amp[keep]
+    order = np.argsort(idx, kind = 'stable')
+    return (idx[order], amp[order])
+
+def initStateSparse(qm, arrinitstep, tol):
+    dtype = idxDtype(qm.nqb)
+    idx = np.zeros(1, dtype = dtype)
+    amp = np.ones(1, dtype = complex)
+    grouped = [False for i in range(qm.nqb)]
+    groups = []
+    for arrinitqb, arrstate in arrinitstep:
+        for qb in arrinitqb:
+            grouped[qb] = True
+        groups.append((arrinitqb, np.array(arrstate, dtype = complex)))
+    # Qubits without initialization are in uniform superposition with unit amplitudes,
+    # the same way as in the dense engines
+    for qb in range(qm.nqb):
+        if not grouped[qb]:
+            groups.append(([qb], np.ones(2, dtype = complex)))
+    for arrinitqb, arrstate in groups:
+        nzkey = np.nonzero(np.abs(arrstate) > tol)[0]
+        scat = scatterBitsNp(len(arrinitqb), arrinitqb, dtype)[nzkey]
+        idx = (idx[:, None] | scat[None, :]).reshape(-1)
+        amp = (amp[:, None] * arrstate[nzkey][None, :]).reshape(-1)
+    return sortSparse(idx, amp, tol)
+
+def prepStepsSparse(qm):
+    arrprepst = []
+    for sttype, stqb, mask, invtbl in prepSteps(qm):
+        nstqb = len(stqb)
+        scat = scatterBitsNp(nstqb, stqb, idxDtype(qm.nqb))
+        if sttype == 'APPOP':
+            op = np.array(invtbl, dtype = complex)
+        else:
+            # Forward map of the local basis states, -1 marks states which are not mapped
+            op = np.full(1<<nstqb, -1, dtype = np.int64)
+            for outb in range(1<<nstqb):
+                if invtbl[outb] != None:
+                    op[invtbl[outb]] = outb
+        arrprepst.append((sttype, stqb, mask, scat, op))
+    return arrprepst
+
+def applyStepSparse(idx, amp, sttype, stqb, mask, scat, op, tol):
+    locidx = gatherBitsNp(idx, stqb)
+    restidx = idx & mask
+    if sttype == 'APPTBL':
+        outb = op[locidx]
+        valid = outb >= 0
+        return sortSparse(restidx[valid] | scat[outb[valid]], amp[valid], tol)
+    else:
+        rest, inv = np.unique(restidx, return_inverse = True)
+        block = np.zeros((len(rest), len(scat)), dtype = complex)
+        block[inv, locidx] = amp
+        block = block @ op.T
+        newidx = (rest[:, None] | scat[None, :]).reshape(-1)
+        return sortSparse(newidx, block.reshape(-1), tol)
+
+def statevecSparse(qm, tol = 0.0, profiler = None):
+    requireNumpy("simulator engine 'sparse'")
+    if profiler != None:
+        profiler.begin()
+    profStart(profiler)
+    idx, amp = initStateSparse(qm, prepInitSteps(qm), tol)
+    profEnd(profiler, prepStepIdx(qm, ['INIT']), 'INIT', qm.nqb, 'sparse init')
+    arrstepidx = prepStepIdx(qm)
+    arrprepst = prepStepsSparse(qm)
+    for k in range(len(arrprepst)):
+        sttype, stqb, mask, scat, op = arrprepst[k]
+        profStart(profiler)
+        idx, amp = applyStepSparse(idx, amp, sttype, stqb, mask, scat, op, tol)
+        profEnd(profiler, [arrstepidx[k]], sttype, len(stqb), 'sparse map' if sttype == 'APPTBL' else 'sparse block matmul')
+    if profiler != None:
+        profiler.end()
+    return SparseState(qm.nqb, idx, amp)
+
+def chunkSlice(chunkqb, chidx):
+    return slice(chidx<<chunkqb, (chidx + 1)<<chunkqb)
+
+def initChunks(data, chunkqb, arrchidx, nqb, arrinitstep):
+    for chidx in arrchidx:
+        data[chunkSlice(chunkqb, chidx)] = initStateNp(nqb, arrinitstep, chunkqb, chidx)
+
+def applyChunks(data, chunkqb, arrchidx, sttype, stpos, op):
+    for chidx in arrchidx:
+        sl = chunkSlice(chunkqb, chidx)
+        data[sl] = applyStepNp(np.array(data[sl]), chunkqb, sttype, stpos, op)
+
+def swapLocalChunks(data, chunkqb, arrchidx, pos1, pos2):
+    for chidx in arrchidx:
+        sl = chunkSlice(chunkqb, chidx)
+        chunk = np.array(data[sl]).reshape([2]*chunkqb)
+        data[sl] = np.swapaxes(chunk, chunkqb - 1 - pos1, chunkqb - 1 - pos2).reshape(-1)
+
+def swapGlobalChunks(data, chunkqb, arrchidx, pos, chbit):
+    # Chunks in arrchidx have the global bit chbit cleared, their local bit pos = 1 half
+    # is exchanged with the local bit pos = 0 half of their pair
+    for chidx in arrchidx:
+        sl0 = chunkSlice(chunkqb, chidx)
+        sl1 = chunkSlice(chunkqb, chidx | chbit)
+        chunk0 = np.array(data[sl0]).reshape(-1, 2, 1<<pos)
+        chunk1 = np.array(data[sl1]).reshape(-1, 2, 1<<pos)
+        tmp = chunk0[:, 1, :].copy()
+        chunk0[:, 1, :] = chunk1[:, 0, :]
+        chunk1[:, 0, :] = tmp
+        data[sl0] = chunk0.reshape(-1)
+        data[sl1] = chunk1.reshape(-1)
+
+class ChunkedState:
+    # State vector processed in chunks of 2^chunkqb amplitudes. The lowest chunkqb
+    # physical qubits are local inside a chunk, logical qubits are mapped to
+    # physical positions by qbpos.
+    def __init__(self, nqb, chunkqb):
+        self.nqb = nqb
+        self.chunkqb = min(chunkqb, nqb)
+        self.nchunk = 1<<(nqb - self.chunkqb)
+        self.qbpos = list(range(nqb))
+        self.posqb = list(range(nqb))
+        self.data = None
+        self.nswap = 0
+
+    def runChunks(self, func, arrchidx, *args):
+        func(self.data, self.chunkqb, arrchidx, *args)
+
+    def init(self, arrinitstep):
+        self.runChunks(initChunks, range(self.nchunk), self.nqb, arrinitstep)
+
+    def swapPos(self, pos1, pos2):
+        if pos1 == pos2:
+            return
+        if pos1 > pos2:
+            pos1, pos2 = pos2, pos1
+        if pos2 < self.chunkqb:
+            self.runChunks(swapLocalChunks, range(self.nchunk), pos1, pos2)
+        elif pos1 < self.chunkqb:
+            chbit = 1<<(pos2 - self.chunkqb)
+            self.runChunks(swapGlobalChunks, [chidx for chidx in range(self.nchunk) if chidx & chbit == 0], pos1, chbit)
+        else:
+            # Two global positions are exchanged through the lowest local one
+            self.swapPos(0, pos1)
+            self.swapPos(0, pos2)
+            self.swapPos(0, pos1)
+            return
+        qb1 = self.posqb[pos1]
+        qb2 = self.posqb[pos2]
+        self.posqb[pos1] = qb2
+        self.posqb[pos2] = qb1
+        self.qbpos[qb1] = pos2
+        self.qbpos[qb2] = pos1
+        self.nswap += 1
+
+    def localize(self, stqb):
+        stpos = [self.qbpos[qb] for qb in stqb]
+        freepos = [pos for pos in range(self.chunkqb - 1, -1, -1) if pos not in stpos]
+        for qb in stqb:
+            if self.qbpos[qb] >= self.chunkqb:
+                self.swapPos(freepos.pop(0), self.qbpos[qb])
+        return [self.qbpos[qb] for qb in stqb]
+
+    def applyStep(self, sttype, stqb, op):
+        if len(stqb) > self.chunkqb:
+            raise QBLError('step acts on %d qubits, which is more than the %d qubits of a chunk' % (len(stqb), self.chunkqb))
+        stpos = self.localize(stqb)
+        self.runChunks(applyChunks, range(self.nchunk), sttype, stpos, op)
+
+    def restoreOrder(self):
+        for qb in range(self.nqb):
+            self.swapPos(qb, self.qbpos[qb])
+
+    def simulate(self, qm, profiler = None):
+        if profiler != None:
+            profiler.begin()
+        profStart(profiler)
+        self.init(prepInitSteps(qm))
+        profEnd(profiler, prepStepIdx(qm, ['INIT']), 'INIT', self.nqb, 'chunked init')
+        arrstepidx = prepStepIdx(qm)
+        arrprepst = prepStepsNp(qm)
+        for k in range(len(arrprepst)):
+            sttype, stqb, op = arrprepst[k]
+            profStart(profiler)
+            nswap = self.nswap
+            self.applyStep(sttype, stqb, op)
+            path = 'chunked ' + stepPathNp(sttype, op)
+            if self.nswap > nswap:
+                path += ' + %d swaps' % (self.nswap - nswap)
+            profEnd(profiler, [arrstepidx[k]], sttype, len(stqb), path)
+        profStart(profiler)
+        nswap = self.nswap
+        self.restoreOrder()
+        profEnd(profiler, [], 'ORDER', self.nqb, '%d swaps' % (self.nswap - nswap))
+        if profiler != None:
+            profiler.end()
+
+class MmapState(ChunkedState):
+    # Chunked state backed by a memory mapped file
+    def __init__(self, nqb, chunkqb, filename = None):
+        super().__init__(nqb, chunkqb)
+        self.istemp = filename == None
+        if self.istemp:
+            fd, filename = tempfile.mkstemp(suffix = '.qblstate')
+            os.close(fd)
+        self.filename = filename
+        self.data = np.memmap(filename, dtype = complex, mode = 'w+', shape = (1<<nqb,))
+
+def statevecMmap(qm, filename = None, chunkqb = 20, profiler = None):
+    requireNumpy("simulator engine 'mmap'")
+    state = MmapState(qm.nqb, chunkqb, filename)
+    try:
+        state.simulate(qm, profiler)
+        state.data.flush()
+    except:
+        if state.istemp:
+            del state.data
+            os.remove(state.filename)
+        raise
+    if state.istemp:
+        weakref.finalize(state.data, os.remove, state.filename)
+    return state.data
+
+shareddata = None
+
+def attachShared(shmname, nqb):
+    global shareddata
+    shm = shared_memory.SharedMemory(name = shmname)
+    shareddata = (shm, np.ndarray((1<<nqb,), dtype = complex, buffer = shm.buf))
+    multiprocessing.util.Finalize(None, detachShared, exitpriority = 10)
+
+def detachShared():
+    # Closes the handle of a worker when it exits, the array on the buffer is released first
+    global shareddata
+    shm = shareddata[0]
+    shareddata = None
+    shm.close()
+
+def runSharedChunks(func, chunkqb, arrchidx, args):
+    func(shareddata[1], chunkqb, arrchidx, *args)
+
+class ShardedState(ChunkedState):
+    # Chunked state in shared memory, the shards (chunks) are processed by a pool of
+    # worker processes. Steps on global (high order) qubits are preceded by qubit swaps
+    # exchanging half-shards between shard pairs.
+    def __init__(self, nqb, nproc, shardqb):
+        if shardqb == None:
+            shardqb = 0
+            while (1<<shardqb) < nproc and shardqb < nqb:
+                shardqb += 1
+        super().__init__(nqb, nqb - shardqb)
+        self.nproc = nproc
+        self.shm = shared_memory.SharedMemory(create = True, size = 16<<nqb)
+        try:
+            self.data = np.ndarray((1<<nqb,), dtype = complex, buffer = self.shm.buf)
+            self.pool = multiprocessing.Pool(nproc, initializer = attachShared, initargs = (self.shm.name, nqb))
+        except:
+            self.data = None
+            self.shm.close()
+            self.shm.unlink()
+            raise
+
+    def runChunks(self, func, arrchidx, *args):
+        arrchidx = list(arrchidx)
+        nper = -(-len(arrchidx) // self.nproc)
+        tasks = [(func, self.chunkqb, arrchidx[i:i + nper], args) for i in range(0, len(arrchidx), nper)]
+        self.pool.starmap(runSharedChunks, tasks)
+
+    def applyStep(self, sttype, stqb, op):
+        if len(stqb) > self.chunkqb:
+            # Steps wider than a shard are applied on the whole state by the main process
+            self.data[:] = applyStepNp(self.data, self.nqb, sttype, [self.qbpos[qb] for qb in stqb], op)
+        else:
+            super().applyStep(sttype, stqb, op)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.data = None
+        self.shm.close()
+        self.shm.unlink()
+
+def statevecParallel(qm, nproc = None, shardqb = None, profiler = None):
+    requireNumpy("simulator engine 'parallel'")
+    if nproc == None:
+        nproc = os.cpu_count()
+    state = ShardedState(qm.nqb, nproc, shardqb)
+    try:
+        state.simulate(qm, profiler)
+        ret = state.data.copy()
+    finally:
+        state.close()
+    return ret
+
+class MPSState:
+    # Matrix product state, site p holds qubit posqb[p] in a tensor of shape (left bond, 2, right bond).
+    # Singular values below cutoff (relative to the largest one) are dropped and bonds are limited
+    # to maxbond, the discarded weight is summed up in truncerr.
+    def __init__(self, nqb, maxbond = None, cutoff = 1e-12):
+        self.nqb = nqb
+        self.maxbond = maxbond
+        self.cutoff = cutoff
+        self.truncerr = 0.0
+        self.nswap = 0
+        self.qbpos = list(range(nqb))
+        self.posqb = list(range(nqb))
+        # Qubits without initialization have unit amplitudes
+        self.tens = [np.ones((1, 2, 1), dtype = complex) for i in range(nqb)]
+
+    def __len__(self):
+        return 1<<self.nqb
+
+    def __getitem__(self, i):
+        vec = np.ones(1, dtype = complex)
+        for pos in range(self.nqb):
+            vec = vec @ self.tens[pos][:, (i >> self.posqb[pos]) & 1, :]
+        return vec[0]
+
+    def __str__(self):
+        return 'MPSState(nqb = %d, maxbond = %d, truncerr = %g)' % (self.nqb, self.getMaxBond(), self.truncerr)
+
+    def getMaxBond(self):
+        return max([t.shape[2] for t in self.tens]) if self.nqb > 0 else 1
+
+    def truncate(self, s):
+        nkeep = max(1, int((s > self.cutoff * s[0]).sum())) if s[0] > 0 else 1
+        if self.maxbond != None:
+            nkeep = min(nkeep, self.maxbond)
+        total = (s**2).sum()
+        if total > 0:
+            self.truncerr += (s[nkeep:]**2).sum() / total
+        return nkeep
+
+    def contractWindow(self, pos, nsite):
+        tens = self.tens[pos]
+        for p in range(pos + 1, pos + nsite):
+            tens = np.tensordot(tens, self.tens[p], axes = (-1, 0))
+        return tens.reshape(tens.shape[0], 1<<nsite, tens.shape[-1])
+
+    def splitWindow(self, pos, nsite, tens):
+        rbond = tens.shape[2]
+        rest = tens.reshape(tens.shape[0], -1)
+        for p in range(pos, pos + nsite - 1):
+            lbond = rest.shape[0]
+            u, s, vh = np.linalg.svd(rest.reshape(lbond * 2, -1), full_matrices = False)
+            nkeep = self.truncate(s)
+            self.tens[p] = u[:, :nkeep].reshape(lbond, 2, nkeep)
+            rest = s[:nkeep, None] * vh[:nkeep]
+        self.tens[pos + nsite - 1] = rest.reshape(rest.shape[0], 2, rbond)
+
+    def swapSites(self, pos):
+        tens = self.contractWindow(pos, 2).reshape(-1, 2, 2, self.tens[pos + 1].shape[2])
+        self.splitWindow(pos, 2, tens.transpose(0, 2, 1, 3).reshape(tens.shape[0], 4, -1))
+        qb1 = self.posqb[pos]
+        qb2 = self.posqb[pos + 1]
+        self.posqb[pos] = qb2
+        self.posqb[pos + 1] = qb1
+        self.qbpos[qb1] = pos + 1
+        self.qbpos[qb2] = pos
+        self.nswap += 1
+
+    def route(self, stqb):
+        # Moves the qubits of a step next to each other with swaps towards their median position,
+        # returns the first position of the window
+        nstqb = len(stqb)
+        arrpos = sorted([self.qbpos[qb] for qb in stqb])
+        mid = nstqb // 2
+        start = arrpos[mid] - mid
+        arrqb = [self.posqb[p] for p in arrpos]
+        for j in range(mid - 1, -1, -1):
+            while self.qbpos[arrqb[j]] < start + j:
+                self.swapSites(self.qbpos[arrqb[j]])
+        for j in range(mid + 1, nstqb):
+            while self.qbpos[arrqb[j]] > start + j:
+                self.swapSites(self.qbpos[arrqb[j]] - 1)
+        return start
+
+    def applyStep(self, sttype, stqb, op):
+        nstqb = len(stqb)
+        pos = self.route(stqb)
+        # perm maps the window index (first site is the most significant bit) to the step's local index
+        winidx = np.arange(1<<nstqb)
+        perm = np.zeros(1<<nstqb, dtype = np.intp)
+        for i in range(nstqb):
+            perm |= ((winidx >> (nstqb - 1 - i)) & 1) << stqb.index(self.posqb[pos + i])
+        tens = self.contractWindow(pos, nstqb)
+        if sttype == 'APPOP':
+            tens = np.einsum('ij,ajb->aib', op[np.ix_(perm, perm)], tens)
+        else:
+            invidx, iszero = op
+            perminv = np.argsort(perm)
+            tens = tens[:, perminv[invidx[perm]], :]
+            if iszero is not None:
+                tens[:, iszero[perm], :] = 0
+        self.splitWindow(pos, nstqb, tens)
+
+    def init(self, arrinitstep):
+        for arrinitqb, arrstate in arrinitstep:
+            arrstate = np.asarray(arrstate, dtype = complex)
+            if len(arrinitqb) == 1:
+                self.tens[self.qbpos[arrinitqb[0]]] = arrstate.reshape(1, 2, 1)
+            else:
+                # Entangled groups are prepared from |0...0> by an operator with the state as first column
+                for qb in arrinitqb:
+                    self.tens[self.qbpos[qb]] = np.array([1, 0], dtype = complex).reshape(1, 2, 1)
+                prep = np.zeros((len(arrstate), len(arrstate)), dtype = complex)
+                prep[:, 0] = arrstate
+                self.applyStep('APPOP', arrinitqb, prep)
+
+    def simulate(self, qm, profiler = None):
+        if profiler != None:
+            profiler.begin()
+        profStart(profiler)
+        self.init(prepInitSteps(qm))
+        profEnd(profiler, prepStepIdx(qm, ['INIT']), 'INIT', self.nqb, 'mps init')
+        arrstepidx = prepStepIdx(qm)
+        arrprepst = prepStepsNp(qm)
+        for k in range(len(arrprepst)):
+            sttype, stqb, op = arrprepst[k]
+            profStart(profiler)
+            nswap = self.nswap
+            self.applyStep(sttype, stqb, op)
+            path = 'mps ' + stepPathNp(sttype, op)
+            if self.nswap > nswap:
+                path += ' + %d swaps' % (self.nswap - nswap)
+            profEnd(profiler, [arrstepidx[k]], sttype, len(stqb), path + ', max bond %d' % self.getMaxBond())
+        if profiler != None:
+            profiler.end()
+
+    def todense(self):
+        tens = self.contractWindow(0, self.nqb).reshape([2]*self.nqb)
+        return np.transpose(tens, [self.qbpos[self.nqb - 1 - ax] for ax in range(self.nqb)]).reshape(-1)
+
+    def getDens(self, arrqb):
+        # Environment of the sites to the left, first index runs over the register values seen so far
+        env = np.ones((1, 1, 1), dtype = complex)
+        arrval = np.zeros(1, dtype = np.int64)
+        for pos in range(self.nqb):
+            tens = self.tens[pos]
+            arrenv = [np.matmul(np.matmul(tens[:, s, :].T, env), tens[:, s, :].conj()) for s in range(2)]
+            qb = self.posqb[pos]
+            if qb in arrqb:
+                env = np.concatenate(arrenv)
+                arrval = np.concatenate([arrval, arrval | (1<<arrqb.index(qb))])
+            else:
+                env = arrenv[0] + arrenv[1]
+        ret = np.zeros(1<<len(arrqb))
+        ret[arrval] = env[:, 0, 0].real
+        return ret
+
+    def sampleIdx(self, shots, rng):
+        renv = [None for i in range(self.nqb + 1)]
+        renv[self.nqb] = np.ones((1, 1), dtype = complex)
+        for pos in range(self.nqb - 1, -1, -1):
+            tens = self.tens[pos]
+            renv[pos] = sum([tens[:, s, :] @ renv[pos + 1] @ tens[:, s, :].conj().T for s in range(2)])
+        idxs = np.zeros(shots, dtype = idxDtype(self.nqb))
+        vec = np.ones((shots, 1), dtype = complex)
+        for pos in range(self.nqb):
+            tens = self.tens[pos]
+            arrvec = [vec @ tens[:, s, :] for s in range(2)]
+            prob = [((v @ renv[pos + 1]) * v.conj()).sum(axis = 1).real for v in arrvec]
+            bit = rng.random(shots) * (prob[0] + prob[1]) >= prob[0]
+            vec = np.where(bit[:, None], arrvec[1], arrvec[0])
+            vec /= np.linalg.norm(vec, axis = 1, keepdims = True)
+            idxs |= bit.astype(idxs.dtype) << self.posqb[pos]
+        return idxs
+
+def statevecMPS(qm, maxbond = None, cutoff = 1e-12, profiler = None):
+    requireNumpy("simulator engine 'mps'")
+    state = MPSState(qm.nqb, maxbond, cutoff)
+    state.simulate(qm, profiler)
+    return state
+
+def statevec(qm, engine = None, **kwargs):
+    if engine == None:
+        engine = 'numpy' if np != None else 'python'
+    if engine == 'python':
+        return statevecPy(qm)
+    elif engine == 'numpy':
+        return statevecNp(qm, **kwargs)
+    elif engine == 'sparse':
+        return statevecSparse(qm, **kwargs)
+    elif engine == 'mmap':
+        return statevecMmap(qm, **kwargs)
+    elif engine == 'parallel':
+        return statevecParallel(qm, **kwargs)
+    elif engine == 'mps':
+        return statevecMPS(qm, **kwargs)
+    else:
+        raise QBLError("unknown simulator engine '%s'" % engine)
+
+def reduceProbs(state, arrqb, chunkqb = 20):
+    # Probabilities summed over all qubits except arrqb, the result is indexed by
+    # the value of arrqb (bit k is qubit arrqb[k]), like getDens
+    nbits = len(arrqb)
+    ret = np.zeros(1<<nbits)
+    if isinstance(state, SparseState):
+        np.add.at(ret, gatherBitsNp(state.idx, arrqb), np.abs(state.amp)**2)
+        return ret
+    if isinstance(state, MPSState):
+        return state.getDens(arrqb)
+    nst = len(state)
+    nqb = nst.bit_length() - 1
+    chunkqb = min(chunkqb, nqb)
+    arrlocqb = [qb for qb in arrqb if qb < chunkqb]
+    arrglobk = [k for k in range(nbits) if arrqb[k] >= chunkqb]
+    locscat = scatterBitsNp(len(arrlocqb), [arrqb.index(qb) for qb in arrlocqb])
+    axes = stepAxes(chunkqb, arrlocqb)
+    front = list(range(len(arrlocqb)))
+    for chidx in range(1<<(nqb - chunkqb)):
+        chunk = np.abs(np.asarray(state[chunkSlice(chunkqb, chidx)]))**2
+        tens = np.moveaxis(chunk.reshape([2]*chunkqb), axes, front)
+        tens = tens.reshape(1<<len(arrlocqb), -1).sum(axis = 1)
+        globkey = 0
+        for k in arrglobk:
+            globkey |= ((chidx >> (arrqb[k] - chunkqb)) & 1) << k
+        ret[locscat | globkey] += tens
+    return ret
+
+def getJointDens(state, arrregs, chunkqb = 20):
+    # Joint probability distribution of registers given as qubit lists, the value of
+    # register i indexes axis i of the returned array
+    allqb = []
+    for reg in arrregs:
+        allqb.extend([qb for qb in reg if qb not in allqb])
+    probs = reduceProbs(state, allqb, chunkqb)
+    locidx = np.arange(1<<len(allqb), dtype = np.int64)
+    keys = tuple([gatherBitsNp(locidx, [allqb.index(qb) for qb in reg]) for reg in arrregs])
+    ret = np.zeros([1<<len(reg) for reg in arrregs])
+    np.add.at(ret, keys, probs)
+    return ret
+
+def getMarginals(state, arrregs, chunkqb = 20):
+    # Marginal distributions of several registers computed from one pass over the state
+    joint = getJointDens(state, arrregs, chunkqb)
+    nreg = len(arrregs)
+    return [joint.sum(axis = tuple([k for k in range(nreg) if k != i])) for i in range(nreg)]
+
+def getRedDensMatr(state, arrqb):
+    # Reduced density matrix of qubits arrqb, indexed the same way as getDens
+    nbits = len(arrqb)
+    if isinstance(state, SparseState):
+        locidx = gatherBitsNp(state.idx, arrqb)
+        mask = 0
+        for qb in arrqb:
+            mask |= 1<<qb
+        rest, inv = np.unique(state.idx & ~mask, return_inverse = True)
+        tens = np.zeros((1<<nbits, len(rest)), dtype = complex)
+        tens[locidx, inv] = state.amp
+    else:
+        state = np.asarray(state)
+        nqb = len(state).bit_length() - 1
+        tens = np.moveaxis(state.reshape([2]*nqb), stepAxes(nqb, arrqb), list(range(nbits)))
+        tens = tens.reshape(1<<nbits, -1)
+    return np.einsum('ir,jr->ij', tens, tens.conj())
+
 def getDens(state, arrqb):
+    if np != None and not isinstance(state, list):
+        return reduceProbs(state, arrqb)
     nst = len(state)
     nbits = len(arrqb)
     rbits = range(nbits)
@@ -115,4 +1059,119 @@ def getDens(state, arrqb):
             itemidx |= ((i>>arrqb[k])&1)<<k
         comp = state[i]
         ret[itemidx] += comp.real*comp.real + comp.imag*comp.imag
-    return ret
\ No newline at end of file
+    return ret
+
+def sampleDenseIdx(state, shots, rng, chunkqb):
+    # Two level sampling: shots are distributed among chunks by their total
+    # probability, then sampled inside the chunks by cumulative sums
+    nst = len(state)
+    chunklen = min(nst, 1<<chunkqb)
+    nchunk = nst // chunklen
+    chprob = np.array([np.sum(np.abs(state[i*chunklen:(i + 1)*chunklen])**2) for i in range(nchunk)])
+    chcnt = rng.multinomial(shots, chprob / chprob.sum())
+    ret = []
+    for i in np.nonzero(chcnt)[0]:
+        cdf = np.cumsum(np.abs(state[i*chunklen:(i + 1)*chunklen])**2)
+        loc = np.searchsorted(cdf, rng.random(chcnt[i]) * cdf[-1], side = 'right')
+        ret.append(i*chunklen + np.minimum(loc, chunklen - 1))
+    return np.concatenate(ret)
+
+def sampleSparseIdx(state, shots, rng):
+    cdf = np.cumsum(np.abs(state.amp)**2)
+    loc = np.searchsorted(cdf, rng.random(shots) * cdf[-1], side = 'right')
+    return state.idx[np.minimum(loc, len(cdf) - 1)]
+
+def sample(qm, state, outidx, shots, seed = None, chunkqb = 20):
+    requireNumpy('function sample')
+    rng = np.random.default_rng(seed)
+    single = type(outidx) != list
+    arroutidx = [outidx] if single else outidx
+    if isinstance(state, SparseState):
+        idxs = sampleSparseIdx(state, shots, rng)
+    elif isinstance(state, MPSState):
+        idxs = state.sampleIdx(shots, rng)
+    else:
+        idxs = sampleDenseIdx(state, shots, rng, chunkqb)
+    values = np.stack([gatherBitsNp(idxs, qm.getOutBits(i, True)) for i in arroutidx], axis = 1)
+    keys, counts = np.unique(values, axis = 0, return_counts = True)
+    ret = {}
+    for i in range(len(keys)):
+        key = int(keys[i][0]) if single else tuple([int(k) for k in keys[i]])
+        ret[key] = int(counts[i])
+    return ret
+
+def getQBitBits(bits, qb, nsamp):
+    # Qubits which were neither inputs nor written by a step are in state 0
+    if qb not in bits:
+        bits[qb] = np.zeros(nsamp, dtype = np.uint8)
+    return bits[qb]
+
+def evalObjBits(obj, bits, nsamp):
+    # Bit arrays of a QBL object from the evaluated qubit values, classical bits are broadcast
+    objclass = obj.getType().value
+    if objclass == 'QBIT':
+        return [getQBitBits(bits, obj.value, nsamp)]
+    elif objclass == 'BIT':
+        return [np.full(nsamp, obj.value, dtype = np.uint8)]
+    elif objclass in ['WORD', 'LIST']:
+        ret = []
+        for el in obj.value:
+            ret.extend(evalObjBits(el, bits, nsamp))
+        return ret
+    return []
+
+def evalClassical(qm, inputs):
+    requireNumpy('function evaluateClassical')
+    if len(inputs) != len(qm.arrinp):
+        raise QBLError('%d input arrays were given, but the logic has %d inputs' % (len(inputs), len(qm.arrinp)))
+    inputs = np.broadcast_arrays(*[np.asarray(inp, dtype = np.int64) for inp in inputs])
+    shape = inputs[0].shape if len(inputs) > 0 else ()
+    nsamp = int(np.prod(shape))
+    bits = {}
+    for inp, val in zip(qm.arrinp, inputs):
+        val = val.reshape(-1)
+        arrqb = []
+        qm.getObjBits(inp, arrqb)
+        for k in range(len(arrqb)):
+            bits[arrqb[k]] = ((val >> k) & 1).astype(np.uint8)
+
+    for stepidx in range(len(qm.arrstep)):
+        step = qm.arrstep[stepidx]
+        if step == None or step.typeid in ['HDGSTART', 'HDGEND']:
+            continue
+        if step.typeid == 'INIT':
+            evalst = step.getEvalState()
+            arrnz = [k for k in range(step.nbase) if abs(evalst[k]) > 1e-12]
+            if len(arrnz) != 1:
+                raise QBLError('step %d initializes a superposition, it cannot be evaluated classically' % stepidx)
+            for k in range(step.nqb):
+                bits[step.arrqb[k]] = np.full(nsamp, (arrnz[0] >> k) & 1, dtype = np.uint8)
+        elif step.typeid == 'APPTBL':
+            tblidx = np.zeros(nsamp, dtype = np.intp)
+            for k in range(step.nin):
+                tblidx |= getQBitBits(bits, step.arrqbin[k], nsamp).astype(np.intp) << k
+            outval = np.asarray(step.tbl, dtype = np.int64)[tblidx]
+            newbits = {}
+            for k in range(step.nin):
+                qb = step.arrqbin[k]
+                newbits[qb] = bits[qb] if step.arrcopy[k] else np.zeros(nsamp, dtype = np.uint8)
+            for k in range(step.nout):
+                qb = step.arrqbout[k]
+                outbit = ((outval >> k) & 1).astype(np.uint8)
+                newbits[qb] = newbits[qb] | outbit if qb in newbits else outbit
+            bits.update(newbits)
+        else:
+            raise QBLError('step %d is a general operator, it cannot be evaluated classically' % stepidx)
+
+    ret = []
+    for out in qm.arrout:
+        arrbit = evalObjBits(out, bits, nsamp)
+        nbits = len(arrbit)
+        signed = out.getType().value == 'WORD' and out.getType().signed
+        val = np.zeros(nsamp, dtype = np.int64 if nbits < 64 else object)
+        for k in range(nbits):
+            val = val | (arrbit[k].astype(val.dtype) << k)
+        if signed and nbits > 0:
+            val = val - (arrbit[nbits - 1].astype(val.dtype) << nbits)
+        ret.append(val.reshape(shape))
+    return ret
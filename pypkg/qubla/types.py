@@ -8,6 +8,8 @@
 from .lazyalg import *
 
 class QBLObject:
+    __slots__ = ('objtype', 'value')
+    
     def __init__(self, objtype, value):
         self.objtype = objtype
         self.value = value
@@ -15,6 +17,9 @@ class QBLObject:
     def __eq__(self, obj):
         return type(self) == type(obj) and self.value == obj.value
     
+    def __hash__(self):
+        return hash((type(self), self.value))
+    
     def getType(self):
         if self.objtype == None:
             return QBLObjectType.ObjType
@@ -28,7 +33,8 @@ class QBLObject:
         return str(self.value)
     
 class QBLObjectType(QBLObject):
-
+    __slots__ = ('hasElements',)
+    
     def __init__(self, typeclass, hasElements = False):
         super().__init__(None, typeclass)
         self.hasElements = hasElements
@@ -37,6 +43,8 @@ class QBLObjectType(QBLObject):
         return str(self.value.lower())
 
 class QBLQBitType(QBLObjectType):
+    __slots__ = ()
+    
     def __init__(self):
         super().__init__('QBIT')
         
@@ -57,10 +65,25 @@ QBLObjectType.Bit = QBLObjectType('BIT')
 QBLObjectType.QBit = QBLQBitType()
 
 class QBLBitObject(QBLObject):
+    __slots__ = ()
+    
+    #the two bit values are shared objects, bits are never modified
+    def __new__(cls, value):
+        return QBLBitObject.bits[value]
+    
     def __init__(self, value):
-        super().__init__(QBLObjectType.Bit, value)
+        pass
+    
+    def __reduce__(self):
+        return QBLBitObject, (self.value,)
+
+QBLBitObject.bits = (object.__new__(QBLBitObject), object.__new__(QBLBitObject))
+QBLObject.__init__(QBLBitObject.bits[0], QBLObjectType.Bit, 0)
+QBLObject.__init__(QBLBitObject.bits[1], QBLObjectType.Bit, 1)
         
 class QBLQBitObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, value):
         super().__init__(QBLObjectType.QBit, value)
     
@@ -68,6 +91,8 @@ class QBLQBitObject(QBLObject):
         return str('qbit[%d]' % self.value)
 
 class QBLIntObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, value):
         super().__init__(QBLObjectType.Int, value)
     
@@ -80,10 +105,18 @@ class QBLIntObject(QBLObject):
         return QBLObjectType.Bit   
     
 class QBLCplxObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, value):
         super().__init__(QBLObjectType.Cplx, value)
+        
+    def __hash__(self):
+        #equal complex values may have different forms
+        return hash(type(self))
 
 class QBLStrObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, value):
         super().__init__(QBLObjectType.Str, value)
    
@@ -99,6 +132,8 @@ class QBLStrObject(QBLObject):
         return 'str("%s")' % self.value  
     
 class QBLWordType(QBLObjectType):
+    __slots__ = ('signed', 'allquantum')
+    
     def __init__(self, signed, allquantum):
         super().__init__('WORD', True)
         self.signed = signed
@@ -109,6 +144,9 @@ class QBLWordType(QBLObjectType):
     
     def __eq__(self, obj):
         return super().__eq__(obj) and self.allquantum == obj.allquantum and self.signed == obj.signed 
+    
+    def __hash__(self):
+        return hash((type(self), self.value, self.signed, self.allquantum))
 
 QBLWordType.Word = QBLWordType(True, False)
 QBLWordType.QWord = QBLWordType(True, True)
@@ -116,8 +154,32 @@ QBLWordType.UWord = QBLWordType(False, False)
 QBLWordType.QUWord = QBLWordType(False, True)
     
 class QBLStructuredWordType(QBLObjectType):
+    __slots__ = ('basetype', 'signed', 'nbits', 'bitstruct')
+    
+    #types qualified by a bit count are shared, keyed by (signed, allquantum, nbits)
+    interned = {}
+    
+    def __new__(cls, basetype, qualifier):
+        if type(qualifier) == int:
+            key = (basetype.signed, basetype.allquantum, qualifier)
+            ret = QBLStructuredWordType.interned.get(key)
+            if ret is None:
+                ret = super().__new__(cls)
+                ret.setQualifier(basetype, qualifier)
+                QBLStructuredWordType.interned[key] = ret
+        else:
+            ret = super().__new__(cls)
+            ret.setQualifier(basetype, qualifier)
+        return ret
+    
     def __init__(self, basetype, qualifier):
-        super().__init__('STRWORD')
+        pass
+    
+    def __reduce__(self):
+        return QBLStructuredWordType, (QBLWordType(self.signed, False), self.bitstruct if self.bitstruct != None else self.nbits)
+    
+    def setQualifier(self, basetype, qualifier):
+        QBLObjectType.__init__(self, 'STRWORD')
         
         if basetype.signed:
             self.basetype = QBLWordType.Word
@@ -141,6 +203,9 @@ class QBLStructuredWordType(QBLObjectType):
         ret= (super().__eq__(obj))
         ret = ret and self.signed == obj.signed and self.bitstruct == obj.bitstruct
         return ret
+    
+    def __hash__(self):
+        return hash((type(self), self.value, self.signed, tuple(self.bitstruct) if self.bitstruct != None else None))
         
     def __str__(self):
         return '%sword{%s}' %  (
@@ -148,26 +213,164 @@ class QBLStructuredWordType(QBLObjectType):
             ('[%s]' % (', '.join([str(b) for b in self.bitstruct]))) if self.bitstruct != None else str(self.nbits)
         )
     
+class QBLWordBits:
+    # Bits of a word: the values of the classical bits packed into cval, the quantum positions in qmask and the qubit
+    # index of a quantum position i in qidx[qoff + i]. Bit objects are only created when a bit is accessed. Slices
+    # and shifts share qidx with their source, it is never modified, reindexing the qubits copies it.
+    __slots__ = ('n', 'cval', 'qmask', 'qidx', 'qoff')
+    
+    def __init__(self, n, cval = 0, qmask = 0, qidx = None, qoff = 0):
+        self.n = n
+        self.cval = cval
+        self.qmask = qmask
+        self.qidx = qidx if qmask != 0 else None
+        self.qoff = qoff
+        
+    def fromList(bits):
+        n = len(bits)
+        cval = 0
+        qmask = 0
+        qidx = None
+        for i in range(n):
+            bit = bits[i]
+            if bit.objtype is QBLObjectType.QBit:
+                if qidx is None:
+                    qidx = [0] * n
+                qidx[i] = bit.value
+                qmask |= 1 << i
+            else:
+                cval |= bit.value << i
+        return QBLWordBits(n, cval, qmask, qidx)
+    
+    def fromQubits(qubits):
+        return QBLWordBits(len(qubits), 0, (1 << len(qubits)) - 1, qubits)
+    
+    def __len__(self):
+        return self.n
+    
+    def __getitem__(self, key):
+        if type(key) == slice:
+            start, stop, step = key.indices(self.n)
+            if step != 1:
+                return QBLWordBits.fromList([self[i] for i in range(start, stop, step)])
+            return self.slice(start, stop)
+        if key < 0:
+            key += self.n
+        if key < 0 or key >= self.n:
+            raise IndexError
+        if (self.qmask >> key) & 1:
+            return QBLQBitObject(self.qidx[self.qoff + key])
+        return QBLBitObject.bits[(self.cval >> key) & 1]
+    
+    def __iter__(self):
+        for i in range(self.n):
+            yield self[i]
+    
+    def qpositions(self):
+        # Positions of the quantum bits in increasing order
+        if self.qmask == (1 << self.n) - 1:
+            return range(self.n)
+        return [i for i, c in enumerate(bin(self.qmask)[:1:-1]) if c == '1']
+    
+    def qubits(self):
+        # Qubit indices of the quantum bits in the order of their positions
+        if self.qmask == 0:
+            return []
+        qidx = self.qidx
+        qoff = self.qoff
+        if self.qmask == (1 << self.n) - 1:
+            return qidx[qoff:qoff + self.n]
+        return [qidx[qoff + i] for i in self.qpositions()]
+    
+    def slice(self, start, stop):
+        n = max(stop - start, 0)
+        mask = (1 << n) - 1
+        qmask = (self.qmask >> start) & mask
+        return QBLWordBits(n, (self.cval >> start) & mask, qmask, self.qidx, self.qoff + start)
+    
+    def lshift(self, sbits):
+        # Bits moved up by sbits positions, the lowest positions set to 0
+        n = self.n
+        if sbits >= n:
+            return QBLWordBits(n)
+        mask = (1 << n) - 1
+        qmask = (self.qmask << sbits) & mask
+        return QBLWordBits(n, (self.cval << sbits) & mask, qmask, self.qidx, self.qoff - sbits)
+    
+    def rshift(self, sbits, signed):
+        # Bits moved down by sbits positions, the highest positions set to the sign bit for signed words, else to 0
+        n = self.n
+        sbits = min(sbits, n)
+        signed = signed and n > 0
+        if signed and (self.qmask >> (n - 1)) & 1:
+            bits = list(self[sbits:n])
+            bits.extend([self[n - 1]] * sbits)
+            return QBLWordBits.fromList(bits)
+        ret = self.slice(sbits, n)
+        ret.n = n
+        if signed and (self.cval >> (n - 1)) & 1:
+            ret.cval |= ((1 << sbits) - 1) << (n - sbits)
+        return ret
+    
+    def resize(self, n, signed):
+        # Bits extended to n positions by the sign bit for signed words, else by 0
+        if n <= self.n:
+            return self.slice(0, n)
+        nadd = n - self.n
+        top = self.n - 1
+        signed = signed and top >= 0
+        if signed and (self.qmask >> top) & 1:
+            bits = list(self)
+            bits.extend([self[top]] * nadd)
+            return QBLWordBits.fromList(bits)
+        ret = self.slice(0, self.n)
+        ret.n = n
+        if signed and (self.cval >> top) & 1:
+            ret.cval |= ((1 << nadd) - 1) << self.n
+        return ret
+    
+    def replaceQubit(self, oldidx, newidx):
+        # Bits with the qubit oldidx replaced by newidx
+        qubits = self.qubits()
+        if oldidx not in qubits:
+            return self
+        qidx = [0] * self.n
+        for i, qbidx in zip(self.qpositions(), qubits):
+            qidx[i] = newidx if qbidx == oldidx else qbidx
+        return QBLWordBits(self.n, self.cval, self.qmask, qidx)
+    
+    def toint(self, signed):
+        if self.qmask != 0:
+            return None
+        if signed and self.n > 0 and (self.cval >> (self.n - 1)) & 1:
+            return self.cval - (1 << self.n)
+        return self.cval
+    
+    def __eq__(self, bits):
+        if type(bits) != QBLWordBits:
+            return list(self) == bits
+        return self.n == bits.n and self.cval == bits.cval and self.qmask == bits.qmask and self.qubits() == bits.qubits()
+    
+    def __hash__(self):
+        return hash((self.n, self.cval, self.qmask, tuple(self.qubits())))
+    
+    def __repr__(self):
+        return repr(list(self))
+
 class QBLWordObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, signed, value):
-        super().__init__(QBLWordType.Word if signed else QBLWordType.UWord, value)
+        super().__init__(QBLWordType.Word if signed else QBLWordType.UWord, value if type(value) == QBLWordBits else QBLWordBits.fromList(value))
         
     def __getitem__(self, key):
         return self.value[key]
     
+    def __hash__(self):
+        return hash((type(self), self.value))
+    
     def toint(self):
-        n = len(self.value)
-        ismin = self.objtype.signed and self.value[n - 1].value == 1 
-        if ismin:
-            n -= 1
-            ret = -(1<<n)
-        else:
-            ret = 0
-        for i in range(n):
-            val = self.value[i];
-            if val.objtype.value != 'BIT': return None
-            ret += self.value[i].value<<i
-        return ret
+        return self.value.toint(self.objtype.signed)
     
     def __str__(self):
         reti = self.toint()
@@ -178,16 +381,23 @@ class QBLWordObject(QBLObject):
 
 #TODO: handle cycles
 class QBLListObject(QBLObject):
+    __slots__ = ()
+    
     def __init__(self, value):
         super().__init__(QBLObjectType.List, value)
                            
     def __getitem__(self, key):
         return self.value[key]
     
+    def __hash__(self):
+        return hash((type(self), tuple(self.value)))
+    
     def __str__(self):
         return '[' + ', '.join([(str(e) if type(e) != list else '[...]') if e != None else 'Uninitialized' for e in self.value ]) + ']'
 
 class QBLDictObject(QBLObject):
+    __slots__ = ('nbits',)
+    
     def __init__(self, nbits, value):
         super().__init__(QBLObjectType.Dict, value)
         self.nbits = nbits
@@ -195,6 +405,9 @@ class QBLDictObject(QBLObject):
     def __getitem__(self, key):
         return self.value[key]
     
+    def __hash__(self):
+        return hash((type(self), frozenset(self.value.items())))
+    
     def __str__(self):
         skey = [str(key) for key in self.value]
         sval = [self.value[key] for key in self.value]
@@ -202,15 +415,22 @@ class QBLDictObject(QBLObject):
         return '{' + ', '.join(['%s : %s' % (skey[i], sval[i]) for i in range(len(skey))]) + '}'    
     
 class QBLFuncListObject(QBLObject):
+    __slots__ = ('name',)
+    
     def __init__(self, name):
         super().__init__(QBLObjectType.FuncList, {})
         self.name = name
         
+    def __hash__(self):
+        return hash((type(self), frozenset(self.value)))
+        
     def __getitem__(self, key):
         return self.value[key]
 
 #TODO: handle identity relation
 class QBLFuncObject(QBLObject):
+    __slots__ = ('functype', 'nargs', 'cmd', 'name')
+    
     def __init__(self, name, functype = None, cmd = None, nargs = None):
         super().__init__(QBLObjectType.Function, None)
         self.functype = functype if functype != None else cmd.deftype
@@ -219,6 +439,8 @@ class QBLFuncObject(QBLObject):
         self.name = name            
             
 class QBLInternalFunc(QBLFuncObject):
+    pure = True #whether calling it has no effect besides the returned value and the steps/qubits added to the logic
+    
     def __init__(self, name, nargs):
         super().__init__(name, functype = 'INTERNAL', nargs = nargs)   
     def call(self, args):